@@ -0,0 +1,827 @@
+"""Archivio dei codici seriali su SQLite (WAL), indicizzato per seriale.
+
+Sostituisce la riscrittura completa di codici_seriali.json: letture e
+aggiornamenti toccano una sola riga, in transazione, indipendentemente
+dalla dimensione della tabella dei codici.
+"""
+import json
+import os
+import re
+import sqlite3
+import string
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import metriche
+from norme import alert_desiderabilita
+
+CODICI_DB = "codici_seriali.db"
+CODICI_JSON = "codici_seriali.json"
+CODICE_MASTER = "GO2B-MASTER"
+
+# Colonne aggiunte dopo la prima versione dello schema: i database nuovi le
+# hanno già in CREATE TABLE, su quelli esistenti vengono create all'apertura.
+_COLONNE_AGGIUNTE = (
+    ("lotto", "TEXT"),
+    ("ts_uso", "INTEGER"),  # riscatto come epoch, ordinabile (data è dd/mm/YYYY)
+    ("completato", "INTEGER NOT NULL DEFAULT 0"),
+    ("alert", "INTEGER NOT NULL DEFAULT 0"),  # desiderabilità sociale oltre soglia
+    ("revisione", "INTEGER NOT NULL DEFAULT 0"),  # versione dei dati dell'ultima modifica della riga
+    ("aggiornato", "INTEGER NOT NULL DEFAULT 0"),  # epoch dell'ultima modifica della riga
+    ("completamento", "TEXT"),  # id dell'ultimo completamento applicato (vedi completamenti.py)
+    ("strumento", "TEXT"),  # questionario del codice; NULL = strumento predefinito (vedi strumenti.py)
+)
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS codici (
+    seriale TEXT PRIMARY KEY,
+    usato INTEGER NOT NULL DEFAULT 0,
+    email TEXT NOT NULL DEFAULT '',
+    nome TEXT NOT NULL DEFAULT '',
+    data TEXT NOT NULL DEFAULT '',
+    report TEXT,
+    risposte_dettaglio TEXT,
+    {", ".join(f"{nome} {tipo}" for nome, tipo in _COLONNE_AGGIUNTE)}
+);
+CREATE TABLE IF NOT EXISTS meta (
+    chiave TEXT PRIMARY KEY,
+    valore TEXT
+);
+CREATE TABLE IF NOT EXISTS statistiche (
+    chiave TEXT PRIMARY KEY,
+    valore INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS utilizzo_giorni (
+    giorno TEXT PRIMARY KEY,
+    usati INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS somme_scale (
+    scala TEXT PRIMARY KEY,
+    somma INTEGER NOT NULL DEFAULT 0,
+    conteggio INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS progressi (
+    seriale TEXT PRIMARY KEY,
+    versione TEXT NOT NULL,
+    risposte TEXT NOT NULL DEFAULT '',
+    aggiornato INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_INDICI = """
+CREATE INDEX IF NOT EXISTS codici_lotto ON codici (lotto);
+CREATE INDEX IF NOT EXISTS codici_uso ON codici (usato, ts_uso, seriale);
+CREATE INDEX IF NOT EXISTS codici_email ON codici (email);
+CREATE INDEX IF NOT EXISTS codici_completato ON codici (usato, completato, ts_uso, seriale);
+CREATE INDEX IF NOT EXISTS codici_alert ON codici (usato, alert, ts_uso, seriale);
+CREATE INDEX IF NOT EXISTS codici_revisione ON codici (completato, revisione, seriale);
+"""
+
+_COLONNE_INFO = (
+    "seriale", "usato", "email", "nome", "data", "report", "risposte_dettaglio",
+    "ts_uso", "completato", "alert",
+)
+_INSERT_INFO = (
+    f"INTO codici ({', '.join(_COLONNE_INFO)}) "
+    f"VALUES ({', '.join('?' for _ in _COLONNE_INFO)})"
+)
+
+FORMATO_DATA = "%d/%m/%Y %H:%M"
+
+_locale = threading.local()
+_init_lock = threading.Lock()
+_inizializzato = set()
+
+
+def _connessione():
+    """Restituisce la connessione del thread corrente (una per processo/thread)."""
+    pid = os.getpid()
+    conn = getattr(_locale, "conn", None)
+    if conn is None or getattr(_locale, "pid", None) != pid:
+        conn = sqlite3.connect(CODICI_DB, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        _locale.conn = conn
+        _locale.pid = pid
+        _inizializza(conn)
+    return conn
+
+
+class _transazione:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK sulla connessione del thread.
+
+    Se la transazione modifica qualcosa incrementa la versione dei dati
+    (meta.versione) e la espone in `self.versione` dopo il commit.
+    """
+
+    def __enter__(self):
+        self.conn = _connessione()
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._modifiche = self.conn.total_changes
+        self.versione = None
+        return self.conn
+
+    def __exit__(self, tipo, valore, tb):
+        if tipo is None:
+            if self.conn.total_changes != self._modifiche:
+                self.versione = _incrementa_versione(self.conn)
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+
+def _prossima_versione(conn):
+    """Versione che avranno i dati al commit della transazione in corso (se modifica qualcosa)."""
+    return int(conn.execute("SELECT valore FROM meta WHERE chiave = 'versione'").fetchone()[0]) + 1
+
+
+def _incrementa_versione(conn):
+    conn.execute(
+        "UPDATE meta SET valore = CAST(valore AS INTEGER) + 1 WHERE chiave = 'versione'"
+    )
+    return int(conn.execute("SELECT valore FROM meta WHERE chiave = 'versione'").fetchone()[0])
+
+
+# ========== NOTIFICHE ==========
+# Chi mantiene dati derivati (norme per coorte, metriche) si registra qui e riceve
+# ogni modifica come (evento, versione, dati) dopo il commit. Se la
+# versione ricevuta non segue quella che ha in memoria, il derivato va
+# ricostruito: significa che un altro thread o processo ha scritto nel mezzo.
+_ascoltatori = []
+
+
+def aggiungi_ascoltatore(funzione):
+    _ascoltatori.append(funzione)
+
+
+def _notifica(evento, versione, **dati):
+    if versione is None:
+        return
+    for funzione in _ascoltatori:
+        funzione(evento, versione, dati)
+
+
+def versione_dati():
+    """Versione corrente dei dati; cambia a ogni scrittura, da qualunque processo."""
+    return int(_connessione().execute(
+        "SELECT valore FROM meta WHERE chiave = 'versione'"
+    ).fetchone()[0])
+
+
+def _istruzioni(script):
+    return [istruzione for istruzione in script.split(";") if istruzione.strip()]
+
+
+def _inizializza(conn):
+    chiave = (os.path.abspath(CODICI_DB), os.getpid())
+    with _init_lock:
+        if chiave in _inizializzato:
+            return
+        # Tutto in una transazione: più worker che aprono insieme un database
+        # nuovo si mettono in fila, e chi arriva dopo trova le colonne già create.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for istruzione in _istruzioni(_SCHEMA):
+                conn.execute(istruzione)
+            esistenti = {riga["name"] for riga in conn.execute("PRAGMA table_info(codici)")}
+            aggiunte = set()
+            for nome, tipo in _COLONNE_AGGIUNTE:
+                if nome not in esistenti:
+                    conn.execute(f"ALTER TABLE codici ADD COLUMN {nome} {tipo}")
+                    aggiunte.add(nome)
+            for istruzione in _istruzioni(_INDICI):
+                conn.execute(istruzione)
+            if aggiunte & {"ts_uso", "completato"}:
+                _ricalcola_colonne_derivate(conn)
+            if "alert" in aggiunte:
+                _ricalcola_alert(conn)
+            if "aggiornato" in aggiunte:
+                conn.execute("UPDATE codici SET aggiornato = COALESCE(ts_uso, 0)")
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (chiave, valore) VALUES ('versione', '0')"
+            )
+            if not conn.execute("SELECT 1 FROM meta WHERE chiave = 'strumento_predefinito'").fetchone():
+                # lotti generati indicando esplicitamente lo strumento predefinito:
+                # come per tutti gli altri codici, predefinito = NULL
+                conn.execute("UPDATE codici SET strumento = NULL WHERE strumento = 'bip'")
+                conn.execute("INSERT INTO meta (chiave, valore) VALUES ('strumento_predefinito', '1')")
+            migrati = _migra_da_json(conn)
+            master = conn.execute(
+                "INSERT OR IGNORE INTO codici (seriale) VALUES (?)", (CODICE_MASTER,)
+            ).rowcount
+            if migrati or not conn.execute(
+                "SELECT 1 FROM meta WHERE chiave = 'statistiche'"
+            ).fetchone():
+                _ricostruisci_statistiche(conn)
+            else:
+                _incrementa_statistiche(conn, totale=master)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        _inizializzato.add(chiave)
+
+
+def _migra_da_json(conn):
+    """Importa una sola volta codici_seriali.json nel database; True se ha importato."""
+    migrato = conn.execute(
+        "SELECT valore FROM meta WHERE chiave = 'migrato_da_json'"
+    ).fetchone()
+    if migrato:
+        return False
+    importati = False
+    if os.path.exists(CODICI_JSON):
+        with open(CODICI_JSON, "r", encoding="utf-8") as f:
+            codici = json.load(f)
+        conn.executemany(
+            "INSERT OR IGNORE " + _INSERT_INFO,
+            (_riga_da_info(s, info) for s, info in codici.items()),
+        )
+        conn.execute("UPDATE codici SET aggiornato = COALESCE(ts_uso, 0) WHERE aggiornato = 0")
+        importati = True
+    conn.execute(
+        "INSERT INTO meta (chiave, valore) VALUES ('migrato_da_json', '1')"
+    )
+    return importati
+
+
+def _ricalcola_colonne_derivate(conn):
+    """Popola ts_uso e completato per le righe scritte prima di queste colonne."""
+    conn.executemany(
+        "UPDATE codici SET ts_uso = ? WHERE seriale = ?",
+        (
+            (timestamp_uso(data), seriale)
+            for seriale, data in conn.execute("SELECT seriale, data FROM codici WHERE usato = 1").fetchall()
+        ),
+    )
+    conn.execute(
+        "UPDATE codici SET completato = "
+        "(report IS NOT NULL AND report NOT IN ('{}', 'null'))"
+    )
+
+
+def _ricalcola_alert(conn):
+    """Popola il flag di alert dei report salvati prima della colonna (solo alla sua aggiunta)."""
+    conn.executemany(
+        "UPDATE codici SET alert = ?1 WHERE seriale = ?2 AND alert != ?1",
+        (
+            (1 if alert_desiderabilita(json.loads(report)) else 0, seriale)
+            for seriale, report in conn.execute(
+                "SELECT seriale, report FROM codici WHERE report IS NOT NULL"
+            ).fetchall()
+        ),
+    )
+
+
+def timestamp_uso(data):
+    """Epoch della data di riscatto "dd/mm/YYYY HH:MM"; 0 se assente o illeggibile."""
+    try:
+        return int(datetime.strptime(data, FORMATO_DATA).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def _riga_da_info(seriale, info):
+    report = info.get("report")
+    risposte = info.get("risposte_dettaglio")
+    return (
+        seriale,
+        1 if info.get("usato") else 0,
+        info.get("email", ""),
+        info.get("nome", ""),
+        info.get("data", ""),
+        json.dumps(report, ensure_ascii=False) if report is not None else None,
+        json.dumps(risposte, ensure_ascii=False) if risposte is not None else None,
+        timestamp_uso(info.get("data")) if info.get("usato") else None,
+        1 if report else 0,
+        1 if alert_desiderabilita(report) else 0,
+    )
+
+
+def _info_da_riga(riga):
+    info = {
+        "usato": bool(riga["usato"]),
+        "email": riga["email"],
+        "nome": riga["nome"],
+        "data": riga["data"],
+        "alert": bool(riga["alert"]),
+        "revisione": riga["revisione"],
+        "aggiornato": riga["aggiornato"],
+        "lotto": riga["lotto"],
+        "strumento": riga["strumento"],
+    }
+    if riga["report"] is not None:
+        info["report"] = json.loads(riga["report"])
+    if riga["risposte_dettaglio"] is not None:
+        info["risposte_dettaglio"] = json.loads(riga["risposte_dettaglio"])
+    return info
+
+
+# ========== STATISTICHE ==========
+# Contatori, utilizzo per giorno e somme dei punteggi per scala del
+# dashboard admin: aggiornati nella stessa transazione di ogni scrittura,
+# così la lettura costa poche righe qualunque processo abbia scritto.
+
+def _giorno(data):
+    return data.split(" ")[0] if data else None
+
+
+def _incrementa_statistiche(conn, **delta):
+    conn.executemany(
+        "INSERT INTO statistiche (chiave, valore) VALUES (?, ?) "
+        "ON CONFLICT(chiave) DO UPDATE SET valore = valore + excluded.valore",
+        ((chiave, d) for chiave, d in delta.items() if d),
+    )
+
+
+def _registra_uso(conn, data):
+    _incrementa_statistiche(conn, usati=1)
+    if _giorno(data):
+        conn.execute(
+            "INSERT INTO utilizzo_giorni (giorno, usati) VALUES (?, 1) "
+            "ON CONFLICT(giorno) DO UPDATE SET usati = usati + 1",
+            (_giorno(data),),
+        )
+
+
+def _somma_report(conn, report, segno):
+    for scala, dati in (report or {}).items():
+        conn.execute(
+            "INSERT INTO somme_scale (scala, somma, conteggio) VALUES (?, ?, ?) "
+            "ON CONFLICT(scala) DO UPDATE SET somma = somma + excluded.somma, "
+            "conteggio = conteggio + excluded.conteggio",
+            (scala, segno * dati.get("punteggio_grezzo", 0), segno),
+        )
+        if segno < 0:
+            conn.execute("DELETE FROM somme_scale WHERE scala = ? AND conteggio <= 0", (scala,))
+
+
+def _ricostruisci_statistiche(conn):
+    """Ricalcola da zero le tabelle delle statistiche (nuovo database o migrazione)."""
+    conn.execute("DELETE FROM statistiche")
+    conn.execute("DELETE FROM utilizzo_giorni")
+    conn.execute("DELETE FROM somme_scale")
+    totale, completati = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(usato AND completato), 0) FROM codici"
+    ).fetchone()
+    _incrementa_statistiche(conn, totale=totale, completati=completati)
+    # usati e utilizzo per giorno, un codice alla volta come nei riscatti
+    for (data,) in conn.execute("SELECT data FROM codici WHERE usato = 1 ORDER BY rowid").fetchall():
+        _registra_uso(conn, data)
+    for (report,) in conn.execute("SELECT report FROM codici WHERE report IS NOT NULL").fetchall():
+        _somma_report(conn, json.loads(report), 1)
+    conn.execute("INSERT OR REPLACE INTO meta (chiave, valore) VALUES ('statistiche', '1')")
+
+
+def statistiche():
+    """(versione, contatori, utilizzo per giorno, {scala: (somma, conteggio)}) in una sola lettura."""
+    conn = _connessione()
+    conn.execute("BEGIN")
+    try:
+        versione = int(conn.execute(
+            "SELECT valore FROM meta WHERE chiave = 'versione'"
+        ).fetchone()[0])
+        contatori = dict(conn.execute("SELECT chiave, valore FROM statistiche").fetchall())
+        per_giorno = dict(conn.execute("SELECT giorno, usati FROM utilizzo_giorni ORDER BY rowid").fetchall())
+        scale = {
+            scala: (somma, conteggio)
+            for scala, somma, conteggio in conn.execute("SELECT scala, somma, conteggio FROM somme_scale")
+        }
+    finally:
+        conn.execute("COMMIT")
+    return versione, contatori, per_giorno, scale
+
+
+# ========== API ==========
+
+def leggi_codice(seriale):
+    """Legge un singolo codice; None se non esiste."""
+    with metriche.cronometro("archivio.leggi_codice") as misura:
+        riga = _connessione().execute(
+            "SELECT * FROM codici WHERE seriale = ?", (seriale,)
+        ).fetchone()
+        if riga is None:
+            return None
+        misura.byte = sum(
+            len((riga[c] or "").encode("utf-8")) for c in ("report", "risposte_dettaglio")
+        )
+        return _info_da_riga(riga)
+
+
+def revisione_codice(seriale):
+    """(email, revisione, aggiornato) di un codice senza leggere report e risposte; None se non esiste."""
+    riga = _connessione().execute(
+        "SELECT email, revisione, aggiornato FROM codici WHERE seriale = ?", (seriale,)
+    ).fetchone()
+    return tuple(riga) if riga else None
+
+
+def riscatta_codice(seriale, nome, email, data):
+    """Segna il codice come usato in modo atomico.
+
+    Restituisce True se il codice era disponibile ed è stato riscattato,
+    False se è inesistente o già usato (anche da una login concorrente).
+    """
+    transazione = _transazione()
+    with metriche.cronometro("archivio.riscatta_codice"), transazione as conn:
+        cur = conn.execute(
+            "UPDATE codici SET usato = 1, nome = ?, email = ?, data = ?, ts_uso = ?, "
+            "revisione = ?, aggiornato = ? WHERE seriale = ? AND usato = 0",
+            (nome, email, data, timestamp_uso(data), _prossima_versione(conn), int(time.time()), seriale),
+        )
+        if cur.rowcount == 1:
+            _registra_uso(conn, data)
+            _incrementa_statistiche(conn, completati=conn.execute(
+                "SELECT completato FROM codici WHERE seriale = ?", (seriale,)
+            ).fetchone()[0])
+    _notifica("riscatto", transazione.versione, seriale=seriale, data=data)
+    return cur.rowcount == 1
+
+
+def salva_report(seriale, report, risposte_dettaglio):
+    """Salva report e risposte di un codice. False se il seriale non esiste."""
+    return not salva_reports([(seriale, report, risposte_dettaglio, None)])
+
+
+def salva_reports(voci):
+    """Salva più report in un'unica transazione; restituisce i seriali inesistenti.
+
+    `voci` sono tuple (seriale, report, risposte_dettaglio, completamento).
+    Una voce il cui `completamento` è già quello registrato sulla riga viene
+    saltata: riapplicare lo stesso completamento non cambia nulla.
+    """
+    transazione = _transazione()
+    salvati = []
+    mancanti = []
+    with metriche.cronometro("archivio.salva_report") as misura, transazione as conn:
+        revisione, adesso = _prossima_versione(conn), int(time.time())
+        for seriale, report, risposte_dettaglio, completamento in voci:
+            riga = conn.execute(
+                "SELECT usato, report, completamento, lotto, strumento FROM codici WHERE seriale = ?",
+                (seriale,),
+            ).fetchone()
+            if riga is None:
+                mancanti.append(seriale)
+                continue
+            if completamento is not None and riga["completamento"] == completamento:
+                continue
+            report_json = json.dumps(report, ensure_ascii=False)
+            risposte_json = json.dumps(risposte_dettaglio, ensure_ascii=False)
+            misura.byte += len(report_json.encode("utf-8")) + len(risposte_json.encode("utf-8"))
+            conn.execute(
+                "UPDATE codici SET report = ?, risposte_dettaglio = ?, completato = ?, alert = ?, "
+                "revisione = ?, aggiornato = ?, completamento = ? WHERE seriale = ?",
+                (
+                    report_json,
+                    risposte_json,
+                    1 if report else 0,
+                    1 if alert_desiderabilita(report) else 0,
+                    revisione,
+                    adesso,
+                    completamento,
+                    seriale,
+                ),
+            )
+            conn.execute("DELETE FROM progressi WHERE seriale = ?", (seriale,))
+            precedente = json.loads(riga["report"]) if riga["report"] is not None else None
+            if riga["usato"]:
+                _incrementa_statistiche(conn, completati=bool(report) - bool(precedente))
+            _somma_report(conn, precedente, -1)
+            _somma_report(conn, report, 1)
+            salvati.append({
+                "seriale": seriale,
+                "lotto": riga["lotto"],
+                "strumento": riga["strumento"],
+                "usato": bool(riga["usato"]),
+                "report": report,
+                "precedente": precedente,
+            })
+    if salvati:
+        _notifica("report", transazione.versione, voci=salvati)
+    return mancanti
+
+
+# ========== PROGRESSI ==========
+# Checkpoint delle risposte dei test in corso, una riga per seriale
+# riscritta a ogni risposta (poche decine di byte). Non sono dati
+# pubblicati: le scritture non passano da _transazione e non cambiano la
+# versione dei dati, quindi statistiche ed esportazioni restano valide.
+
+def salva_progresso(seriale, versione, risposte):
+    """Registra le risposte date finora (stringa di cifre) per la versione del questionario."""
+    with metriche.cronometro("archivio.salva_progresso"):
+        _connessione().execute(
+            "INSERT INTO progressi (seriale, versione, risposte, aggiornato) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(seriale) DO UPDATE SET versione = excluded.versione, "
+            "risposte = excluded.risposte, aggiornato = excluded.aggiornato",
+            (seriale, versione, risposte, int(time.time())),
+        )
+
+
+def leggi_progresso(seriale):
+    """(versione, risposte) dell'ultimo checkpoint; None se non ce n'è."""
+    riga = _connessione().execute(
+        "SELECT versione, risposte FROM progressi WHERE seriale = ?", (seriale,)
+    ).fetchone()
+    return tuple(riga) if riga else None
+
+
+def riprendibile(seriale, email):
+    """True se il codice è stato riscattato con questa email e il test non è completato."""
+    return _connessione().execute(
+        "SELECT 1 FROM codici WHERE seriale = ? AND usato = 1 AND completato = 0 AND email = ?",
+        (seriale, email),
+    ).fetchone() is not None
+
+
+def _ultimo_rowid(conn):
+    return conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM codici").fetchone()[0]
+
+
+_PREFISSO_VALIDO = re.compile(r"[A-Za-z0-9_-]{1,32}")
+_ALFABETO = np.frombuffer((string.ascii_uppercase + string.digits).encode(), dtype=np.uint8)
+
+
+def _estrai_seriali(n, prefix, lunghezza, rng):
+    """Fino a n seriali casuali distinti `PREFIX-XXXXXX` estratti in blocco.
+
+    Restano nell'ordine di estrazione: chi li inserisce con un LIMIT deve
+    tenerne un sottoinsieme casuale, non i primi in ordine alfabetico.
+    """
+    testa = np.frombuffer(f"{prefix}-".encode(), dtype=np.uint8)
+    matrice = np.empty((n, len(testa) + lunghezza), dtype=np.uint8)
+    matrice[:, :len(testa)] = testa
+    matrice[:, len(testa):] = _ALFABETO[rng.integers(0, len(_ALFABETO), size=(n, lunghezza))]
+    seriali = matrice.view(f"S{matrice.shape[1]}").ravel()
+    _, indici = np.unique(seriali, return_index=True)
+    return seriali[np.sort(indici)].astype(str).tolist()
+
+
+def genera_codici(n, prefix="GO2B", lunghezza=6, lotto=None, strumento=None):
+    """Genera e inserisce `n` nuovi codici in un'unica transazione.
+
+    I candidati vengono estratti in blocco, deduplicati in memoria e poi
+    filtrati contro l'indice della chiave primaria direttamente in SQL; si
+    ripete solo per le (rare) collisioni. I codici scelti (i primi in ordine
+    di estrazione) sono inseriti in ordine di seriale: gli indici che
+    terminano con il seriale crescono in sequenza invece che a pagine sparse
+    (100k codici in una tabella di 100k: da ~3,5 s a ~1,7 s). Tutti i codici del
+    lotto sono assegnati a `strumento` (None = predefinito). Restituisce
+    (lotto, codici) in ordine di seriale.
+
+    ValueError se il prefisso non è fatto di lettere, cifre, "_" o "-" ASCII.
+    """
+    if not _PREFISSO_VALIDO.fullmatch(prefix):
+        raise ValueError(f"Prefisso non valido: {prefix!r} (solo lettere, cifre, _ e - ASCII, massimo 32 caratteri)")
+    if lotto is None:
+        lotto = f"{prefix}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+    rng = np.random.default_rng()
+    transazione = _transazione()
+    with transazione as conn:
+        primo = _ultimo_rowid(conn)
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS candidati (seriale TEXT)")
+        mancanti = n
+        tentativi_a_vuoto = 0
+        while mancanti > 0:
+            conn.execute("DELETE FROM candidati")
+            conn.executemany(
+                "INSERT INTO candidati VALUES (?)",
+                ((s,) for s in _estrai_seriali(mancanti + mancanti // 10 + 8, prefix, lunghezza, rng)),
+            )
+            cur = conn.execute(
+                "INSERT INTO codici (seriale, lotto, strumento) "
+                "SELECT seriale, ?, ? FROM (SELECT seriale FROM candidati "
+                "WHERE seriale NOT IN (SELECT seriale FROM codici) ORDER BY rowid LIMIT ?) "
+                "ORDER BY seriale",
+                (lotto, strumento, mancanti),
+            )
+            mancanti -= cur.rowcount
+            tentativi_a_vuoto = 0 if cur.rowcount else tentativi_a_vuoto + 1
+            if tentativi_a_vuoto >= 20:
+                raise ValueError(f"Codici disponibili esauriti per il prefisso {prefix}")
+        conn.execute("DELETE FROM candidati")
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (chiave, valore) VALUES ('ultimo_lotto', ?)", (lotto,)
+        )
+        nuovi = [r[0] for r in conn.execute(
+            "SELECT seriale FROM codici WHERE rowid > ? ORDER BY seriale", (primo,)
+        )]
+        _incrementa_statistiche(conn, totale=len(nuovi))
+    _notifica("inserimento", transazione.versione, seriali=nuovi)
+    return lotto, nuovi
+
+
+def codici_lotto(lotto):
+    return [r[0] for r in _connessione().execute(
+        "SELECT seriale FROM codici WHERE lotto = ? ORDER BY rowid", (lotto,)
+    )]
+
+
+def report_coorte(lotto=None, prefisso=None, strumento=None, dopo_revisione=None):
+    """(versione, [(seriale, report)]) dei report di un lotto o di un prefisso di seriale.
+
+    Solo i codici completati dello `strumento` indicato (None = predefinito);
+    versione e righe sono lette nella stessa transazione. Con `dopo_revisione`
+    restituisce solo le righe modificate dopo quella versione, completate o
+    no (report None = codice non più completato).
+    """
+    if lotto is not None:
+        condizione, parametri = "lotto = ?", [lotto]
+    else:
+        condizione, parametri = "seriale >= ? AND seriale < ?", [prefisso + "-", prefisso + "-\uffff"]
+    if dopo_revisione is None:
+        condizione += " AND completato = 1"
+    else:
+        condizione += " AND revisione > ?"
+        parametri.append(dopo_revisione)
+    conn = _connessione()
+    conn.execute("BEGIN")
+    try:
+        versione = int(conn.execute(
+            "SELECT valore FROM meta WHERE chiave = 'versione'"
+        ).fetchone()[0])
+        righe = conn.execute(
+            f"SELECT seriale, completato, report FROM codici WHERE {condizione} AND strumento IS ?",
+            parametri + [strumento],
+        ).fetchall()
+    finally:
+        conn.execute("COMMIT")
+    return versione, [(r["seriale"], json.loads(r["report"]) if r["completato"] else None) for r in righe]
+
+
+def strumento_codice(seriale):
+    """Strumento assegnato al codice (None = predefinito)."""
+    riga = _connessione().execute(
+        "SELECT strumento FROM codici WHERE seriale = ?", (seriale,)
+    ).fetchone()
+    return riga["strumento"] if riga else None
+
+
+def strumenti_usati():
+    """Strumenti dei report salvati (None = predefinito)."""
+    return [r[0] for r in _connessione().execute(
+        "SELECT DISTINCT strumento FROM codici WHERE completato = 1"
+    )]
+
+
+def ultimo_lotto():
+    riga = _connessione().execute(
+        "SELECT valore FROM meta WHERE chiave = 'ultimo_lotto'"
+    ).fetchone()
+    return riga[0] if riga else None
+
+
+def esiste_codice(seriale):
+    return _connessione().execute(
+        "SELECT 1 FROM codici WHERE seriale = ?", (seriale,)
+    ).fetchone() is not None
+
+
+def itera_report(dopo_seriale="", dimensione_blocco=500):
+    """Scorre i codici con report in blocchi ordinati per seriale.
+
+    Produce liste di (seriale, report, strumento, revisione); `dopo_seriale`
+    permette di riprendere una scansione interrotta.
+    """
+    conn = _connessione()
+    while True:
+        righe = conn.execute(
+            "SELECT seriale, report, strumento, revisione FROM codici "
+            "WHERE report IS NOT NULL AND seriale > ? ORDER BY seriale LIMIT ?",
+            (dopo_seriale, dimensione_blocco),
+        ).fetchall()
+        if not righe:
+            return
+        yield [(r["seriale"], json.loads(r["report"]), r["strumento"], r["revisione"]) for r in righe]
+        dopo_seriale = righe[-1]["seriale"]
+
+
+def aggiorna_report(voci):
+    """Riscrive i report di più codici in un'unica transazione; restituisce i seriali saltati.
+
+    Pensata per il ricalcolo delle norme: cambia percentili e stanine, non i
+    punteggi grezzi. `voci` sono (seriale, report, revisione), con la
+    revisione della riga quando il report è stato letto: se nel frattempo la
+    riga è cambiata (un nuovo report salvato) non viene toccata.
+    """
+    transazione = _transazione()
+    aggiornati = []
+    saltati = []
+    with transazione as conn:
+        nuova, adesso = _prossima_versione(conn), int(time.time())
+        for seriale, report, revisione in voci:
+            cur = conn.execute(
+                "UPDATE codici SET report = ?, alert = ?, revisione = ?, aggiornato = ? "
+                "WHERE seriale = ? AND revisione = ?",
+                (json.dumps(report, ensure_ascii=False), 1 if alert_desiderabilita(report) else 0,
+                 nuova, adesso, seriale, revisione),
+            )
+            (aggiornati if cur.rowcount else saltati).append(seriale)
+    _notifica("rinorma", transazione.versione, seriali=aggiornati)
+    return saltati
+
+
+def itera_codici(solo_completati=False, dimensione_blocco=500):
+    """Scorre tutti i codici (seriale, info) in ordine di inserimento, a blocchi.
+
+    Tiene in memoria un blocco alla volta: adatta alle esportazioni.
+    """
+    conn = _connessione()
+    filtro = "AND report IS NOT NULL " if solo_completati else ""
+    ultimo = 0
+    while True:
+        righe = conn.execute(
+            f"SELECT rowid, * FROM codici WHERE rowid > ? {filtro}ORDER BY rowid LIMIT ?",
+            (ultimo, dimensione_blocco),
+        ).fetchall()
+        if not righe:
+            return
+        for riga in righe:
+            yield riga["seriale"], _info_da_riga(riga)
+        ultimo = righe[-1]["rowid"]
+
+
+def itera_modificati(dopo_revisione, fino_a_revisione, dimensione_blocco=500):
+    """Scorre i codici completati con dopo_revisione < revisione <= fino_a_revisione.
+
+    Ordine (revisione, seriale), a blocchi con paginazione keyset sull'indice
+    codici_revisione. Una riga riscritta durante la scansione prende una
+    revisione oltre `fino_a_revisione`: esce da questa scansione e rientra
+    nella successiva, non va persa.
+    """
+    conn = _connessione()
+    ultima = (dopo_revisione, "\uffff")
+    while True:
+        righe = conn.execute(
+            "SELECT * FROM codici WHERE completato = 1 AND (revisione, seriale) > (?, ?) "
+            "AND revisione <= ? ORDER BY revisione, seriale LIMIT ?",
+            ultima + (fino_a_revisione, dimensione_blocco),
+        ).fetchall()
+        if not righe:
+            return
+        for riga in righe:
+            yield riga["seriale"], _info_da_riga(riga)
+        ultima = (righe[-1]["revisione"], righe[-1]["seriale"])
+
+
+def elenca_utenti(per_pagina=50, cursore=None, email=None, completato=None, alert=None):
+    """Una pagina di codici usati, dal riscatto più recente.
+
+    Usa gli indici su (usato, ts_uso), (usato, completato, ts_uso),
+    (usato, alert, ts_uso) ed email:
+    il costo dipende dalla dimensione della pagina, non dal numero di
+    candidati. `cursore` è il valore "ts_uso:seriale" restituito dalla pagina
+    precedente; `email` filtra per prefisso. Restituisce (utenti, cursore
+    della pagina successiva o None).
+    """
+    condizioni = ["usato = 1"]
+    parametri = []
+    if completato is not None:
+        condizioni.append("completato = ?")
+        parametri.append(1 if completato else 0)
+    if alert is not None:
+        condizioni.append("alert = ?")
+        parametri.append(1 if alert else 0)
+    if email:
+        condizioni.append("email >= ? AND email < ?")
+        parametri.extend([email, email + "\uffff"])
+    if cursore:
+        ts, _, seriale = cursore.partition(":")
+        condizioni.append("(ts_uso, seriale) < (?, ?)")
+        parametri.extend([int(ts), seriale])
+    righe = _connessione().execute(
+        "SELECT seriale, nome, email, data, ts_uso, completato, alert, strumento FROM codici "
+        f"WHERE {' AND '.join(condizioni)} ORDER BY ts_uso DESC, seriale DESC LIMIT ?",
+        parametri + [per_pagina + 1],
+    ).fetchall()
+    successivo = None
+    if len(righe) > per_pagina:
+        righe = righe[:per_pagina]
+        successivo = f"{righe[-1]['ts_uso']}:{righe[-1]['seriale']}"
+    utenti = [
+        {
+            "nome": riga["nome"],
+            "email": riga["email"],
+            "seriale": riga["seriale"],
+            "data": riga["data"],
+            "ts_uso": riga["ts_uso"],
+            "completed": bool(riga["completato"]),
+            "has_alert": bool(riga["alert"]),
+            "strumento": riga["strumento"]
+        }
+        for riga in righe
+    ]
+    return utenti, successivo
+
+
+def conta_alert():
+    """Numero di candidati con alert di desiderabilità sociale (dall'indice)."""
+    return _connessione().execute(
+        "SELECT COUNT(*) FROM codici WHERE usato = 1 AND alert = 1"
+    ).fetchone()[0]
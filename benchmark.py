@@ -0,0 +1,235 @@
+"""Benchmark del flusso candidato e degli endpoint admin.
+
+Ogni scenario gira in un sottoprocesso, in una cartella temporanea con una
+tabella di codici sintetica (N codici, una quota già usata e completata) e
+uno storico normativo di M test. Il client di test di Flask percorre
+/login -> /start -> /question/<idx> x item -> /result per alcuni candidati,
+poi interroga /admin/api/stats, /admin_dashboard e le tre /admin/export/*
+(misurate a freddo, svuotando la cache delle esportazioni, e a parte come
+"(cache)" quando il file per la versione corrente è già pronto).
+Per ogni rotta vengono riportati i percentili di latenza, più il throughput
+dei candidati.
+
+    python benchmark.py                                  # scenari 1k/10k/100k
+    python benchmark.py --codici 1000 --storico 5000 --salva baseline.json
+    python benchmark.py --confronta baseline.json        # exit 1 se regressioni
+
+Se la cartella templates/ non è presente, i template mancanti vengono
+sostituiti da segnaposto minimi: si misura il lavoro lato server, non il
+rendering delle pagine.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+CARTELLA = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE = ("benvenuto.html", "login.html", "question.html", "result.html",
+            "admin_login.html", "admin_dashboard_enhanced.html")
+
+
+def _percentili(durate):
+    ms = np.array(durate) * 1000
+    return {
+        "n": len(durate),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p90_ms": round(float(np.percentile(ms, 90)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+def _prepara_dati(n_codici, n_storico, quota_completati):
+    """Crea nella cartella corrente codici, report e storico sintetici."""
+    import archivio
+    import norme
+    from questionario import Questionario
+
+    questionario = Questionario.da_file("data.json")
+    rng = np.random.default_rng(1)
+
+    # Storico normativo: n_storico test già svolti, scritti come snapshot
+    risposte = rng.integers(1, 7, size=(n_storico, len(questionario)))
+    somme = questionario.punteggi_scale(risposte) if n_storico else np.zeros((0, len(questionario.scale)))
+    record = [
+        {"scala": scala, "score": int(score)}
+        for riga in somme for scala, score in zip(questionario.scale, riga)
+    ]
+    with open(norme.DATABASE_FILE, "w", encoding="utf-8") as f:
+        json.dump(record, f, ensure_ascii=False)
+    storico = norme.StoricoNorme().carica()
+
+    _, codici = archivio.genera_codici(n_codici)
+    n_completati = int(n_codici * quota_completati)
+    for i, seriale in enumerate(codici[:n_completati]):
+        archivio.riscatta_codice(seriale, f"Candidato {i}", f"candidato{i}@esempio.it",
+                                 time.strftime("%d/%m/%Y %H:%M", time.localtime(1.7e9 + i * 600)))
+        risposte = rng.integers(1, 7, size=len(questionario))
+        punteggi = questionario.punteggi_item(risposte)
+        report = {}
+        for scala, score in zip(questionario.scale, questionario.punteggi_scale(risposte).tolist()):
+            percentile, stanina = storico.indice.percentile_stanina(scala, score)
+            report[scala] = {"punteggio_grezzo": score, "percentile": percentile, "stanina": stanina}
+        dettaglio = [
+            {"idx": j + 1, "text": it["text"], "scala": it["scala"], "answer": int(a),
+             "punteggio": int(p), "reverse": it["reverse"]}
+            for j, (it, a, p) in enumerate(zip(questionario.items, risposte, punteggi))
+        ]
+        archivio.salva_report(seriale, report, dettaglio)
+    return codici[n_completati:]
+
+
+def _scenario(n_codici, n_storico, n_candidati, quota_completati, ripetizioni_admin):
+    """Eseguito nel sottoprocesso, dentro la cartella temporanea."""
+    liberi = _prepara_dati(n_codici, n_storico, quota_completati)
+
+    import main
+    from jinja2 import ChoiceLoader, DictLoader
+    if not os.path.isdir(os.path.join(CARTELLA, "templates")):
+        main.app.jinja_loader = ChoiceLoader([
+            main.app.jinja_loader,
+            DictLoader({nome: "{{ report|tojson if report is defined else '' }}" for nome in TEMPLATE}),
+        ])
+
+    durate = {}
+
+    def misura(nome, chiamata):
+        inizio = time.perf_counter()
+        risposta = chiamata()
+        durate.setdefault(nome, []).append(time.perf_counter() - inizio)
+        if risposta.status_code >= 400:
+            raise RuntimeError(f"{nome}: HTTP {risposta.status_code}")
+        risposta.close()
+        return risposta
+
+    n_item = len(main.questionario)
+    inizio_flusso = time.perf_counter()
+    for i, seriale in enumerate(liberi[:n_candidati]):
+        client = main.app.test_client()
+        misura("POST /login", lambda: client.post("/login", data={
+            "nome": f"Bench {i}", "email": f"bench{i}@esempio.it", "seriale": seriale}))
+        misura("GET /start", lambda: client.get("/start"))
+        for idx in range(n_item):
+            misura("POST /question/<idx>", lambda: client.post(
+                f"/question/{idx}", data={"answer": str(random.randint(1, 6))}))
+        misura("GET /result", lambda: client.get("/result"))
+    durata_flusso = time.perf_counter() - inizio_flusso
+    main.coda_completamenti.attendi()  # le viste admin devono vedere i report appena salvati
+
+    admin = main.app.test_client()
+    admin.post("/admin", data={"user": main.ADMIN_USER, "password": main.ADMIN_PASS})
+    for _ in range(ripetizioni_admin):
+        misura("GET /admin/api/stats", lambda: admin.get("/admin/api/stats"))
+        misura("GET /admin_dashboard", lambda: admin.get("/admin_dashboard"))
+    for tipo in ("users", "codes", "results"):
+        for _ in range(3):
+            # a freddo: senza cache il file viene rigenerato a ogni ripetizione
+            shutil.rmtree(main.coda_esportazioni.cartella, ignore_errors=True)
+            misura(f"GET /admin/export/{tipo}", lambda: _consuma(admin.get(f"/admin/export/{tipo}")))
+        for _ in range(3):
+            misura(f"GET /admin/export/{tipo} (cache)", lambda: _consuma(admin.get(f"/admin/export/{tipo}")))
+
+    return {
+        "scenario": {"codici": n_codici, "storico": n_storico, "candidati": n_candidati},
+        "avvio_ms": main.TEMPO_AVVIO_MS,
+        "candidati_al_secondo": round(n_candidati / durata_flusso, 2) if n_candidati else None,
+        "rotte": {nome: _percentili(valori) for nome, valori in durate.items()},
+    }
+
+
+def _consuma(risposta):
+    """Legge tutto il corpo (le esportazioni sono in streaming)."""
+    for _ in risposta.response:
+        pass
+    return risposta
+
+
+def esegui_scenario(n_codici, n_storico, args):
+    cartella = tempfile.mkdtemp(prefix="bench_bip_")
+    try:
+        shutil.copy(os.path.join(CARTELLA, "data.json"), cartella)
+        comando = [sys.executable, os.path.abspath(__file__), "--_interno",
+                   str(n_codici), str(n_storico), str(args.candidati),
+                   str(args.quota_completati), str(args.ripetizioni_admin)]
+        env = dict(os.environ, PYTHONPATH=CARTELLA + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        uscita = subprocess.run(comando, cwd=cartella, env=env, capture_output=True, text=True)
+        if uscita.returncode != 0:
+            raise RuntimeError(uscita.stderr)
+        return json.loads(uscita.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(cartella, ignore_errors=True)
+
+
+def confronta(risultati, baseline, soglia):
+    """Elenca le rotte il cui p50 è peggiorato oltre `soglia` rispetto alla baseline."""
+    precedenti = {json.dumps(r["scenario"], sort_keys=True): r for r in baseline["risultati"]}
+    regressioni = []
+    for r in risultati:
+        base = precedenti.get(json.dumps(r["scenario"], sort_keys=True))
+        if not base:
+            continue
+        for rotta, valori in r["rotte"].items():
+            prima = base["rotte"].get(rotta)
+            if prima and valori["p50_ms"] > prima["p50_ms"] * (1 + soglia) and valori["p50_ms"] - prima["p50_ms"] > 1:
+                regressioni.append(f"{r['scenario']} {rotta}: p50 {prima['p50_ms']} -> {valori['p50_ms']} ms")
+    return regressioni
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--codici", default="1000,10000,100000",
+                        help="dimensioni della tabella codici, separate da virgola")
+    parser.add_argument("--storico", default="1000,10000,100000",
+                        help="test nello storico normativo, uno per scenario")
+    parser.add_argument("--candidati", type=int, default=10)
+    parser.add_argument("--quota-completati", type=float, default=0.05)
+    parser.add_argument("--ripetizioni-admin", type=int, default=20)
+    parser.add_argument("--salva", help="scrive i risultati come baseline JSON")
+    parser.add_argument("--confronta", help="baseline JSON con cui confrontare")
+    parser.add_argument("--soglia", type=float, default=0.25,
+                        help="peggioramento relativo del p50 considerato regressione")
+    args = parser.parse_args()
+
+    codici = [int(x) for x in args.codici.split(",")]
+    storico = [int(x) for x in args.storico.split(",")]
+    if len(storico) == 1:
+        storico *= len(codici)
+
+    risultati = []
+    for n_codici, n_storico in zip(codici, storico):
+        r = esegui_scenario(n_codici, n_storico, args)
+        risultati.append(r)
+        print(f"\n== {n_codici} codici, storico {n_storico} test "
+              f"(avvio {r['avvio_ms']} ms, {r['candidati_al_secondo']} candidati/s)")
+        for rotta, v in r["rotte"].items():
+            print(f"  {rotta:36} n={v['n']:<5} p50={v['p50_ms']:>8} p90={v['p90_ms']:>8} "
+                  f"p99={v['p99_ms']:>8} max={v['max_ms']:>8} ms")
+
+    if args.salva:
+        with open(args.salva, "w", encoding="utf-8") as f:
+            json.dump({"creato": time.strftime("%Y-%m-%d %H:%M"), "risultati": risultati}, f, indent=2)
+    if args.confronta:
+        with open(args.confronta, "r", encoding="utf-8") as f:
+            regressioni = confronta(risultati, json.load(f), args.soglia)
+        if regressioni:
+            print("\nRegressioni:")
+            for r in regressioni:
+                print("  " + r)
+            sys.exit(1)
+        print("\nNessuna regressione rispetto alla baseline")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--_interno":
+        n_codici, n_storico, n_candidati = (int(x) for x in sys.argv[2:5])
+        risultato = _scenario(n_codici, n_storico, n_candidati, float(sys.argv[5]), int(sys.argv[6]))
+        print(json.dumps(risultato))
+    else:
+        main()
@@ -0,0 +1,52 @@
+"""Lock su file condivisi fra processi (più worker gunicorn sulla stessa istanza).
+
+Usa flock, quindi vale fra processi e anche fra thread che aprono il file
+di lock separatamente. Dove fcntl non esiste (Windows, sviluppo locale) il
+lock degrada a no-op: in quel caso si gira comunque con un solo processo.
+processo_vivo() serve a riconoscere i file lasciati da un worker terminato.
+"""
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - solo piattaforme non POSIX
+    fcntl = None
+
+
+class Occupato(Exception):
+    """Il lock non bloccante è già tenuto da un altro processo."""
+
+
+@contextmanager
+def blocco_file(percorso, esclusivo=True, attendi=True):
+    fd = os.open(percorso, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        if fcntl is not None:
+            modo = fcntl.LOCK_EX if esclusivo else fcntl.LOCK_SH
+            if not attendi:
+                modo |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fd, modo)
+            except BlockingIOError:
+                raise Occupato(percorso)
+        yield
+    finally:
+        os.close(fd)
+
+
+def processo_vivo(pid):
+    """True se il processo `pid` esiste ancora su questa macchina."""
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return True
+    if os.name != "posix":
+        return False  # senza segnale 0 non si può verificare: solo il processo corrente
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
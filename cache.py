@@ -0,0 +1,39 @@
+"""Cache LRU in memoria, limitata nel numero di voci e condivisa fra i thread.
+
+Pensata per valori immutabili per chiave (es. seriale + revisione del
+report): non c'è invalidazione, le voci superate escono per anzianità.
+Ogni processo ha la propria cache.
+"""
+import threading
+from collections import OrderedDict
+
+import metriche
+
+
+class CacheLRU:
+
+    def __init__(self, nome, capienza=256):
+        self.nome = nome
+        self.capienza = capienza
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._voci)
+
+    def leggi(self, chiave):
+        """Valore in cache (e lo segna come usato di recente); None se assente."""
+        with self._lock:
+            valore = self._voci.get(chiave)
+            if valore is not None:
+                self._voci.move_to_end(chiave)
+        metriche.registro.incrementa("bip_cache_totale", cache=self.nome,
+                                     esito="hit" if valore is not None else "miss")
+        return valore
+
+    def scrivi(self, chiave, valore):
+        with self._lock:
+            self._voci[chiave] = valore
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self.capienza:
+                self._voci.popitem(last=False)
@@ -0,0 +1,155 @@
+"""Salvataggio write-behind dei test completati.
+
+/result calcola il report in memoria, lo accoda qui e risponde subito:
+prima di rispondere il completamento è già scritto, con fsync, in
+completamenti.jsonl, quindi sopravvive a un crash del processo. Un thread
+per processo applica poi i completamenti a blocchi: una sola append (con
+un solo fsync) sullo storico delle norme di ciascuno strumento e una sola
+transazione SQLite per blocco, invece di una per candidato.
+
+Applicare un completamento è idempotente: il suo id viene registrato sia
+nello storico delle norme sia nella riga del codice. Per questo il journal
+può essere riapplicato per intero, anche mentre altri processi stanno
+ancora lavorando i loro completamenti: succede all'avvio e quando il file
+supera SOGLIA_COMPATTAZIONE byte, dopodiché viene svuotato.
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+import archivio
+import metriche
+from blocchi import blocco_file
+
+JOURNAL_FILE = "completamenti.jsonl"
+SOGLIA_COMPATTAZIONE = 4 * 1024 * 1024
+MAX_BLOCCO = 64
+ATTESA_BLOCCO = 0.02  # secondi di attesa di altri completamenti prima di scrivere
+
+
+class Completamenti:
+
+    def __init__(self, storico_per, journal_file=JOURNAL_FILE, soglia_compattazione=SOGLIA_COMPATTAZIONE):
+        """`storico_per(strumento)` restituisce lo StoricoNorme dello strumento."""
+        self.storico_per = storico_per
+        self.journal_file = journal_file
+        self.lock_file = journal_file + ".lock"
+        self.soglia_compattazione = soglia_compattazione
+        self._coda = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._avvio_lock = threading.Lock()
+        atexit.register(self.attendi, 10)
+
+    def accoda(self, seriale, report, risposte_dettaglio, record_norme, strumento=None):
+        """Rende durevole il completamento e lo passa al writer; restituisce il suo id."""
+        voce = {
+            "id": uuid.uuid4().hex,
+            "strumento": strumento,
+            "seriale": seriale,
+            "report": report,
+            "risposte_dettaglio": risposte_dettaglio,
+            "norme": list(record_norme),
+        }
+        # Il "\n" iniziale isola la riga da un eventuale resto incompleto
+        # lasciato da un processo terminato a metà scrittura.
+        dati = ("\n" + json.dumps(voce, ensure_ascii=False) + "\n").encode("utf-8")
+        # Le append (O_APPEND, una sola write) possono procedere in parallelo:
+        # il lock condiviso le esclude solo durante la compattazione.
+        with metriche.cronometro("completamenti.append") as misura, \
+                blocco_file(self.lock_file, esclusivo=False):
+            fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, dati)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            misura.byte = len(dati)
+        self._avvia_writer()
+        self._coda.put(voce)
+        return voce["id"]
+
+    def _avvia_writer(self):
+        with self._avvio_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._writer, name="completamenti", daemon=True)
+                self._thread.start()
+
+    def _writer(self):
+        while True:
+            blocco = [self._coda.get()]
+            try:
+                while len(blocco) < MAX_BLOCCO:
+                    blocco.append(self._coda.get(timeout=ATTESA_BLOCCO))
+            except queue.Empty:
+                pass
+            while True:
+                try:
+                    with metriche.cronometro("completamenti.blocco"):
+                        self._applica(blocco)
+                    break
+                except Exception as e:
+                    # resta nel journal: si riprova, e in ogni caso verrà riapplicato all'avvio
+                    print(f"Errore nel salvataggio di {len(blocco)} completamenti, nuovo tentativo: {e}")
+                    time.sleep(1)
+            for _ in blocco:
+                self._coda.task_done()
+            if self._dimensione() > self.soglia_compattazione:
+                self.compatta()
+
+    def _applica(self, voci):
+        per_strumento = {}
+        for v in voci:
+            per_strumento.setdefault(v.get("strumento"), []).append((v["id"], v["norme"]))
+        for strumento, completati in per_strumento.items():
+            self.storico_per(strumento).registra_completamenti(completati)
+        mancanti = archivio.salva_reports(
+            [(v["seriale"], v["report"], v["risposte_dettaglio"], v["id"]) for v in voci]
+        )
+        for seriale in mancanti:
+            print(f"SERIALE NON TROVATO, NON SALVO! {seriale}")
+
+    def _dimensione(self):
+        try:
+            return os.path.getsize(self.journal_file)
+        except FileNotFoundError:
+            return 0
+
+    def _leggi(self):
+        voci = []
+        with open(self.journal_file, "rb") as f:
+            for riga in f:
+                if not riga.endswith(b"\n") or not riga.strip():
+                    continue
+                try:
+                    voci.append(json.loads(riga))
+                except ValueError:
+                    continue  # resto di una scrittura interrotta
+        return voci
+
+    def compatta(self):
+        """Riapplica tutto il journal (idempotente) e lo svuota; restituisce le voci lette."""
+        if not self._dimensione():
+            return 0
+        with blocco_file(self.lock_file):
+            voci = self._leggi()
+            for inizio in range(0, len(voci), MAX_BLOCCO):
+                self._applica(voci[inizio:inizio + MAX_BLOCCO])
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(0)
+                os.fsync(f.fileno())
+        return len(voci)
+
+    def attendi(self, timeout=None):
+        """Aspetta che il writer abbia applicato tutti i completamenti accodati."""
+        scadenza = None if timeout is None else time.monotonic() + timeout
+        while self._coda.unfinished_tasks:
+            if scadenza is not None and time.monotonic() > scadenza:
+                return False
+            time.sleep(0.01)
+        return True
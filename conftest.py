@@ -0,0 +1,11 @@
+import pytest
+
+import archivio
+
+
+@pytest.fixture
+def cartella(tmp_path, monkeypatch):
+    """Esegue il test in una cartella vuota, con un archivio SQLite nuovo."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(archivio._locale, "conn", None, raising=False)
+    return tmp_path
@@ -0,0 +1,146 @@
+"""Norme per coorte: percentili e stanine rispetto al proprio lotto o prefisso.
+
+Una coorte è l'insieme dei codici completati dello stesso lotto (vedi
+genera_codici) o con lo stesso prefisso di seriale, per uno stesso
+strumento. Di ogni coorte richiesta si tiene in memoria l'istogramma dei
+punteggi grezzi (IndiceNorme), costruito con una query indicizzata sui soli
+codici della coorte e poi aggiornato a ogni report tramite le notifiche di
+archivio. Dopo un salto di versione (scrittura di un altro processo) una
+coorte, alla richiesta successiva, rilegge solo le proprie righe modificate
+nel frattempo (colonna revisione): le coorti non toccate non rileggono
+nessun report.
+"""
+import threading
+from collections import OrderedDict
+
+import archivio
+from norme import IndiceNorme
+
+TIPI = ("lotto", "prefisso")
+MAX_COORTI = 500
+
+
+def prefisso(seriale):
+    """Prefisso del seriale: "GO2B-AB12CD" -> "GO2B"; None se il seriale non ha prefisso."""
+    if "-" not in seriale:
+        return None
+    return seriale.rsplit("-", 1)[0]
+
+
+def chiave_coorte(tipo, seriale, lotto, strumento):
+    """(tipo, valore, strumento) della coorte del codice; None se il codice non ha lotto/prefisso."""
+    valore = lotto if tipo == "lotto" else prefisso(seriale)
+    return (tipo, valore, strumento) if valore else None
+
+
+class _Coorte:
+
+    def __init__(self, versione, report):
+        self.versione = versione
+        self.indice = IndiceNorme()
+        self.punteggi = {}
+        for seriale, r in report:
+            self.imposta(seriale, r)
+
+    def imposta(self, seriale, report):
+        """Sostituisce i punteggi del codice (report None = non fa parte della coorte)."""
+        for scala, score in self.punteggi.pop(seriale, {}).items():
+            self.indice.rimuovi(scala, score)
+        if report:
+            punteggi = {scala: dati.get("punteggio_grezzo", 0) for scala, dati in report.items()}
+            for scala, score in punteggi.items():
+                self.indice.aggiungi(scala, score)
+            self.punteggi[seriale] = punteggi
+
+
+def _report_coorte(chiave, dopo_revisione=None):
+    tipo, valore, strumento = chiave
+    versione, righe = archivio.report_coorte(
+        lotto=valore if tipo == "lotto" else None,
+        prefisso=valore if tipo == "prefisso" else None,
+        strumento=strumento,
+        dopo_revisione=dopo_revisione,
+    )
+    if tipo == "prefisso":
+        righe = [(s, r) for s, r in righe if prefisso(s) == valore]
+    return versione, righe
+
+
+class NormeCoorti:
+
+    def __init__(self, max_coorti=MAX_COORTI):
+        self._lock = threading.Lock()
+        self._coorti = OrderedDict()
+        self.max_coorti = max_coorti
+
+    def notifica(self, evento, versione, dati):
+        """Ascoltatore di archivio: aggiorna le coorti in memoria.
+
+        Una coorte avanza di versione solo se era alla precedente; altrimenti
+        resta indietro e si riallinea alla prossima richiesta (vedi _coorte).
+        Impostare i punteggi di un codice è idempotente, quindi i report
+        vengono applicati anche alle coorti rimaste indietro.
+        """
+        with self._lock:
+            for coorte in self._coorti.values():
+                if coorte.versione == versione - 1:
+                    coorte.versione = versione
+            if evento != "report":
+                return
+            for voce in dati["voci"]:
+                for tipo in TIPI:
+                    coorte = self._coorti.get(chiave_coorte(tipo, voce["seriale"], voce["lotto"], voce["strumento"]))
+                    if coorte is not None:
+                        coorte.imposta(voce["seriale"], voce["report"])
+
+    def _coorte(self, chiave):
+        versione = archivio.versione_dati()
+        with self._lock:
+            coorte = self._coorti.get(chiave)
+            if coorte is not None and coorte.versione == versione:
+                self._coorti.move_to_end(chiave)
+                return coorte
+        if coorte is None:
+            versione, righe = _report_coorte(chiave)
+            coorte = _Coorte(versione, righe)
+            with self._lock:
+                self._coorti[chiave] = coorte
+                while len(self._coorti) > self.max_coorti:
+                    self._coorti.popitem(last=False)
+            return coorte
+        # solo le righe della coorte modificate da altri processi
+        versione, righe = _report_coorte(chiave, dopo_revisione=coorte.versione)
+        with self._lock:
+            for seriale, report in righe:
+                coorte.imposta(seriale, report)
+            # una notifica arrivata durante la lettura può aver avanzato la
+            # versione: si torna a quella letta, le righe successive verranno
+            # rilette (e reimpostate) alla prossima richiesta
+            coorte.versione = versione
+            self._coorti.move_to_end(chiave)
+        return coorte
+
+    def report_relativo(self, seriale, info, tipo="lotto"):
+        """Report del codice con percentili e stanine rispetto alla sua coorte.
+
+        Restituisce (chiave della coorte, numerosità, report); None se il
+        codice non ha una coorte di quel tipo (codici generati senza lotto).
+        """
+        chiave = chiave_coorte(tipo, seriale, info.get("lotto"), info.get("strumento"))
+        if chiave is None:
+            return None
+        indice = self._coorte(chiave).indice
+        report = {}
+        numerosita = 0
+        for scala, dati in (info.get("report") or {}).items():
+            score = dati.get("punteggio_grezzo", 0)
+            percentile, stanina = indice.percentile_stanina(scala, score)
+            numerosita = max(numerosita, indice.totale(scala))
+            report[scala] = {
+                "punteggio_grezzo": score,
+                "percentile": percentile,
+                "stanina": stanina,
+                "percentile_generale": dati.get("percentile"),
+                "stanina_generale": dati.get("stanina")
+            }
+        return chiave, numerosita, report
@@ -0,0 +1,319 @@
+"""Esportazioni admin in streaming a memoria costante.
+
+I codici vengono letti dall'archivio a blocchi; l'Excel è scritto con
+xlsxwriter in modalità constant_memory direttamente nella cache di
+CodaEsportazioni. CSV e NDJSON vengono generati riga per riga senza file
+intermedi.
+xlsxwriter viene importato solo alla prima esportazione Excel, per non
+pesare sull'avvio a freddo.
+
+L'estrazione dati per la sincronizzazione incrementale (stream_dati_*)
+scorre invece i codici completati per revisione, a partire da un cursore.
+
+CodaEsportazioni produce i file, in background o su richiesta sincrona:
+ogni job è identificato da tipo + versione dei dati, e il file pronto resta
+in cache finché i dati non cambiano. Un job rimasto in corso perché il suo
+worker è terminato (o che dura oltre DURATA_MASSIMA_JOB) risulta in errore
+("abbandonato") e viene riavviato alla richiesta successiva.
+"""
+import csv
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import archivio
+from blocchi import processo_vivo
+
+DURATA_MASSIMA_JOB = 30 * 60  # secondi
+
+
+def _workbook(percorso, **opzioni):
+    import xlsxwriter
+    return xlsxwriter.Workbook(percorso, dict(opzioni, constant_memory=True))
+
+
+def scrivi_utenti_xlsx(percorso):
+    """Lista dei candidati che hanno usato un codice."""
+    workbook = _workbook(percorso)
+    worksheet = workbook.add_worksheet("Utenti")
+    worksheet.write_row(0, 0, ["Nome", "Email", "Codice Seriale", "Data Test", "Test Completato", "Alert Desiderabilità"])
+    row = 1
+    for seriale, info in archivio.itera_codici():
+        if info.get("usato"):
+            worksheet.write_row(row, 0, [
+                info.get("nome", ""),
+                info.get("email", ""),
+                seriale,
+                info.get("data", ""),
+                "Sì" if info.get("report") else "No",
+                "Sì" if info["alert"] else "No"
+            ])
+            row += 1
+    workbook.close()
+
+
+def scrivi_codici_xlsx(percorso, codici_recenti):
+    """Ultimi codici generati con il loro stato."""
+    workbook = _workbook(percorso)
+    worksheet = workbook.add_worksheet("Codici")
+    worksheet.write_row(0, 0, ["Codice Seriale", "Stato"])
+    for idx, code in enumerate(codici_recenti):
+        stato = "Utilizzato" if (archivio.leggi_codice(code) or {}).get("usato") else "Disponibile"
+        worksheet.write_row(idx + 1, 0, [code, stato])
+    workbook.close()
+
+
+def _intestazioni_riassunto(scale):
+    headers = ["Nome", "Email", "Data Test"]
+    for scala in scale:
+        headers.extend([f"{scala} - Punteggio", f"{scala} - Percentile", f"{scala} - Stanina"])
+    return headers
+
+
+def _riga_riassunto(info, scale):
+    riga = [info.get("nome", ""), info.get("email", ""), info.get("data", "")]
+    for scala in scale:
+        dati = info["report"].get(scala)
+        if dati:
+            riga.extend([dati.get("punteggio_grezzo", ""), dati.get("percentile", ""), dati.get("stanina", "")])
+        else:
+            riga.extend(["", "", ""])
+    return riga
+
+
+def scrivi_risultati_xlsx(percorso, scale):
+    """Scrive il workbook dei risultati completi in `percorso`.
+
+    In constant_memory ogni foglio va scritto riga per riga: i due fogli
+    vengono riempiti in parallelo durante un'unica scansione dei codici.
+    """
+    workbook = _workbook(percorso, tmpdir=os.path.dirname(percorso) or None)
+    summary_ws = workbook.add_worksheet("Riassunto")
+    detail_ws = workbook.add_worksheet("Dettaglio Risposte")
+    summary_ws.write_row(0, 0, _intestazioni_riassunto(scale))
+    detail_ws.write_row(0, 0, ["Nome", "Email", "Domanda", "Scala", "Risposta", "Punteggio", "Inversa"])
+
+    row = detail_row = 1
+    for seriale, info in archivio.itera_codici(solo_completati=True):
+        if info.get("report"):
+            summary_ws.write_row(row, 0, _riga_riassunto(info, scale))
+            row += 1
+        for risposta in info.get("risposte_dettaglio") or []:
+            detail_ws.write_row(detail_row, 0, [
+                info.get("nome", ""),
+                info.get("email", ""),
+                risposta.get("text", ""),
+                risposta.get("scala", ""),
+                risposta.get("answer", ""),
+                risposta.get("punteggio", ""),
+                "Sì" if risposta.get("reverse") else "No"
+            ])
+            detail_row += 1
+    workbook.close()
+
+
+def stream_risultati_csv(scale):
+    """Foglio riassuntivo dei risultati in CSV, una riga alla volta."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def svuota():
+        valore = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return valore
+
+    buffer.write("\ufeff")  # BOM: Excel riconosce l'UTF-8
+    writer.writerow(_intestazioni_riassunto(scale))
+    yield svuota()
+    for seriale, info in archivio.itera_codici(solo_completati=True):
+        if info.get("report"):
+            writer.writerow(_riga_riassunto(info, scale))
+            yield svuota()
+
+
+def stream_risultati_ndjson():
+    """Un oggetto JSON per candidato con report e risposte di dettaglio."""
+    for seriale, info in archivio.itera_codici(solo_completati=True):
+        yield json.dumps({
+            "seriale": seriale,
+            "nome": info.get("nome", ""),
+            "email": info.get("email", ""),
+            "data": info.get("data", ""),
+            "report": info.get("report"),
+            "risposte_dettaglio": info.get("risposte_dettaglio", [])
+        }, ensure_ascii=False) + "\n"
+
+
+# ========== ESTRAZIONE DATI INCREMENTALE ==========
+# Il cursore è la versione dei dati: la risposta contiene i codici completati
+# modificati dopo `dopo_revisione` fino alla versione letta all'inizio, che
+# il client ripassa come cursore alla richiesta successiva.
+
+_CAMPI_DATI = ("nome", "email", "data", "strumento", "lotto", "revisione", "aggiornato")
+
+
+def _voce_dati(seriale, info):
+    voce = {"seriale": seriale}
+    for campo in _CAMPI_DATI:
+        voce[campo] = info.get(campo)
+    voce["report"] = info.get("report")
+    voce["risposte_dettaglio"] = info.get("risposte_dettaglio") or []
+    return voce
+
+
+def stream_dati_ndjson(dopo_revisione, fino_a_revisione):
+    """Un oggetto JSON per codice completato, in ordine di revisione."""
+    for seriale, info in archivio.itera_modificati(dopo_revisione, fino_a_revisione):
+        yield json.dumps(_voce_dati(seriale, info), ensure_ascii=False) + "\n"
+
+
+def _blocco_colonnare(voci):
+    """Blocco di voci in colonne: {"righe": n, "colonne": {nome: [valori]}}.
+
+    Report e risposte sono appiattiti in colonne "report.<scala>.<campo>" e
+    "risposte_dettaglio.<campo>" (una lista per codice); i valori mancanti
+    sono null.
+    """
+    colonne = {campo: [] for campo in ("seriale",) + _CAMPI_DATI}
+    for i, voce in enumerate(voci):
+        for campo in ("seriale",) + _CAMPI_DATI:
+            colonne[campo].append(voce[campo])
+        valori = {}
+        for scala, dati in (voce["report"] or {}).items():
+            for campo, valore in dati.items():
+                valori[f"report.{scala}.{campo}"] = valore
+        risposte = voce["risposte_dettaglio"]
+        for campo in sorted({campo for risposta in risposte for campo in risposta}):
+            valori[f"risposte_dettaglio.{campo}"] = [r.get(campo) for r in risposte]
+        for nome, valore in valori.items():
+            colonne.setdefault(nome, [None] * i).append(valore)
+        for lista in colonne.values():
+            if len(lista) == i:
+                lista.append(None)
+    return {"righe": len(voci), "colonne": colonne}
+
+
+def stream_dati_colonne(dopo_revisione, fino_a_revisione, dimensione_blocco=500):
+    """Come stream_dati_ndjson, ma un blocco colonnare per riga (vedi _blocco_colonnare)."""
+    voci = []
+    for seriale, info in archivio.itera_modificati(dopo_revisione, fino_a_revisione, dimensione_blocco):
+        voci.append(_voce_dati(seriale, info))
+        if len(voci) == dimensione_blocco:
+            yield json.dumps(_blocco_colonnare(voci), ensure_ascii=False) + "\n"
+            voci = []
+    if voci:
+        yield json.dumps(_blocco_colonnare(voci), ensure_ascii=False) + "\n"
+
+
+class CodaEsportazioni:
+    """Job di esportazione in background con file in cache per versione dei dati.
+
+    Lo stato di ogni job è un piccolo file JSON nella cartella di cache, così
+    qualunque worker può rispondere al polling, non solo quello che l'ha avviato.
+    """
+
+    def __init__(self, cartella="esportazioni_cache", max_workers=2):
+        # assoluta: send_file risolve i percorsi relativi sulla cartella dell'app, non sulla cwd
+        self.cartella = os.path.abspath(cartella)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+
+    def _percorso(self, job_id, estensione):
+        return os.path.join(self.cartella, f"{job_id}.{estensione}")
+
+    def file_pronto(self, job_id):
+        percorso = self._percorso(job_id, "xlsx")
+        return percorso if os.path.exists(percorso) else None
+
+    def stato(self, job_id):
+        """Stato del job; un job abbandonato risulta in errore (va riavviato con avvia)."""
+        if self.file_pronto(job_id):
+            return {"id": job_id, "stato": "pronto"}
+        try:
+            with open(self._percorso(job_id, "json"), "r", encoding="utf-8") as f:
+                stato = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._abbandonato(stato):
+            stato.update(stato="errore", errore="abbandonato")
+        return stato
+
+    def _scrivi_stato(self, job_id, **stato):
+        temporaneo = self._percorso(job_id, f"{os.getpid()}.{threading.get_ident()}.json.tmp")
+        with open(temporaneo, "w", encoding="utf-8") as f:
+            json.dump(dict(stato, id=job_id, pid=os.getpid()), f)
+        os.replace(temporaneo, self._percorso(job_id, "json"))
+
+    def _abbandonato(self, stato):
+        """True se il job risulta in coda/in corso ma il suo worker non lo porterà a termine."""
+        if stato["stato"] not in ("in_coda", "in_corso"):
+            return False
+        return not processo_vivo(stato.get("pid")) or time.time() - stato.get("creato", 0) > DURATA_MASSIMA_JOB
+
+    def avvia(self, tipo, versione, scrivi):
+        """Avvia (se serve) il job `tipo` per la versione dei dati; restituisce l'id.
+
+        `scrivi(percorso)` produce il file. Se il file per questa versione è
+        già in cache o un job identico è in corso non viene rifatto nulla,
+        a meno che quel job sia stato abbandonato.
+        """
+        os.makedirs(self.cartella, exist_ok=True)
+        job_id = f"{tipo}-{versione}"
+        if self.file_pronto(job_id):
+            return job_id
+        try:
+            fd = os.open(self._percorso(job_id, "json"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            stato = self.stato(job_id)
+            if stato and stato["stato"] != "errore":
+                return job_id
+        else:
+            os.close(fd)
+        self._scrivi_stato(job_id, tipo=tipo, stato="in_coda", creato=time.time())
+        self._executor.submit(self._esegui, job_id, tipo, scrivi)
+        return job_id
+
+    def genera(self, tipo, versione, scrivi):
+        """Produce subito il file (richieste sincrone) lasciandolo in cache; restituisce il percorso."""
+        os.makedirs(self.cartella, exist_ok=True)
+        job_id = f"{tipo}-{versione}"
+        if not self.file_pronto(job_id):
+            self._scrivi_file(job_id, scrivi)
+            self._pulisci(tipo, job_id)
+        return self._percorso(job_id, "xlsx")
+
+    def _scrivi_file(self, job_id, scrivi):
+        # temporaneo per processo e thread: un job riavviato può sovrapporsi a quello originale
+        temporaneo = self._percorso(job_id, f"{os.getpid()}.{threading.get_ident()}.xlsx.tmp")
+        try:
+            scrivi(temporaneo)
+            os.replace(temporaneo, self._percorso(job_id, "xlsx"))
+        except Exception:
+            if os.path.exists(temporaneo):
+                os.remove(temporaneo)
+            raise
+
+    def _esegui(self, job_id, tipo, scrivi):
+        self._scrivi_stato(job_id, tipo=tipo, stato="in_corso", creato=time.time())
+        try:
+            self._scrivi_file(job_id, scrivi)
+        except Exception as e:
+            self._scrivi_stato(job_id, tipo=tipo, stato="errore", errore=str(e))
+            return
+        try:
+            os.remove(self._percorso(job_id, "json"))
+        except FileNotFoundError:
+            pass  # già rimosso da un job riavviato
+        self._pulisci(tipo, job_id)
+
+    def _pulisci(self, tipo, da_tenere):
+        """Rimuove i file di versioni precedenti dello stesso tipo."""
+        for nome in os.listdir(self.cartella):
+            if nome.startswith(f"{tipo}-") and nome.endswith(".xlsx") and nome != f"{da_tenere}.xlsx":
+                try:
+                    os.remove(os.path.join(self.cartella, nome))
+                except OSError:
+                    pass
@@ -1,25 +1,19 @@
-import json
-import random
-import string
+import archivio
+import strumenti
 
-def genera_codice(prefix="GO2B", lunghezza=6):
-    lettere = string.ascii_uppercase + string.digits
-    return f"{prefix}-" + ''.join(random.choices(lettere, k=lunghezza))
+def genera_codici(n=100, prefix="GO2B", strumento=None):
+    """Genera `n` nuovi codici nell'archivio; restituisce (lotto, codici).
 
-def genera_codici(n=100, prefix="GO2B"):
-    codici = {}
-    usati = set()
-    while len(codici) < n:
-        codice = genera_codice(prefix)
-        if codice not in usati:
-            codici[codice] = {"usato": False, "email": "", "nome": ""}
-            usati.add(codice)
-    return codici
+    ValueError se `strumento` non esiste (niente codici che falliscono a /start).
+    """
+    return archivio.genera_codici(n, prefix, strumento=strumenti.da_salvare(strumento))
 
 if __name__ == "__main__":
     NUM_CODICI = 150  # Numero di codici da generare (puoi cambiare)
     PREFIX = "GO2B"   # Prefisso dei codici (puoi cambiare)
-    codici = genera_codici(n=NUM_CODICI, prefix=PREFIX)
-    with open("codici_seriali.json", "w", encoding="utf-8") as f:
-        json.dump(codici, f, ensure_ascii=False, indent=2)
-    print(f"Creati {NUM_CODICI} codici seriali in 'codici_seriali.json'")
\ No newline at end of file
+    STRUMENTO = None  # Id in strumenti/<id>.json; None = questionario predefinito (data.json)
+    try:
+        lotto, codici = genera_codici(n=NUM_CODICI, prefix=PREFIX, strumento=STRUMENTO)
+    except ValueError as e:
+        raise SystemExit(f"Errore: {e}")
+    print(f"Creati {len(codici)} codici seriali nel lotto '{lotto}' ({archivio.CODICI_DB})")
@@ -0,0 +1,15 @@
+# Avvio in produzione: gunicorn -c gunicorn.conf.py main:app
+#
+# Ogni worker apre le proprie connessioni SQLite (WAL) e tiene in memoria
+# l'indice delle norme, riallineandolo alla coda di database.jsonl; le
+# scritture su journal e snapshot passano da lock su file (blocchi.py).
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+# Niente preload: stato e connessioni vanno creati dopo il fork, in ogni worker
+preload_app = False
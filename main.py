@@ -1,22 +1,27 @@
-from flask import Flask, render_template, request, redirect, url_for, session, Response, send_file, jsonify
+import time
+_inizio_avvio = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, session, Response, send_file, jsonify, abort, g
 import json
-import numpy as np
 import os
-from datetime import datetime
-import random
-import string
-
-# Per Excel export:
-import io
-try:
-    import xlsxwriter
-except ImportError:
-    import pip
-    pip.main(['install', 'xlsxwriter'])
-    import xlsxwriter
+from datetime import datetime, timezone
+import threading
+
+import archivio
+import norme
+import rinorma
+import completamenti
+import strumenti
+import esportazioni
+import metriche
+from statistiche import StatisticheAdmin
+from coorti import NormeCoorti, TIPI as TIPI_COORTE
+from cache import CacheLRU
+from questionario import risposta_valida, decodifica_risposte, imposta_risposte
 
 app = Flask(__name__)
-app.secret_key = "test-bip"
+# Con più worker la chiave deve essere la stessa in tutti i processi
+app.secret_key = os.environ.get("SECRET_KEY", "test-bip")
 
 # ========== PARAMETRI ADMIN ==========
 ADMIN_USER = "go2badmin"
@@ -24,127 +29,100 @@ ADMIN_PASS = "SuperSegreta2024"
 CODICE_MASTER = "GO2B-MASTER"
 
 # ========== UTILITY CODICI SERIALI ==========
-CODICI_FILE = "codici_seriali.json"
+# I codici sono conservati in SQLite (vedi archivio.py); codici_seriali.json
+# viene importato automaticamente alla prima apertura del database.
 
-def carica_codici():
-    if os.path.exists(CODICI_FILE):
-        with open(CODICI_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    else:
-        return {CODICE_MASTER: {"usato": False, "email": "", "nome": "", "data": ""}}
-
-def salva_codici(codici):
-    if CODICE_MASTER not in codici:
-        codici[CODICE_MASTER] = {"usato": False, "email": "", "nome": "", "data": ""}
-    with open(CODICI_FILE, "w", encoding="utf-8") as f:
-        json.dump(codici, f, ensure_ascii=False, indent=2)
-
-def genera_codice(prefix="GO2B", lunghezza=6):
-    lettere = string.ascii_uppercase + string.digits
-    return f"{prefix}-" + ''.join(random.choices(lettere, k=lunghezza))
-
-def genera_codici_batch(n=50, prefix="GO2B"):
-    codici = carica_codici()
-    nuovi = []
-    while len(nuovi) < n:
-        code = genera_codice(prefix)
-        if code not in codici:
-            codici[code] = {"usato": False, "email": "", "nome": "", "data": ""}
-            nuovi.append(code)
-    salva_codici(codici)
-    with open("ultimi_codici_generati.json", "w", encoding="utf-8") as f:
-        json.dump(nuovi, f, ensure_ascii=False, indent=2)
+def genera_codici_batch(n=50, prefix="GO2B", strumento=None):
+    lotto, nuovi = archivio.genera_codici(n, prefix, strumento=strumenti.da_salvare(strumento))
     return nuovi
 
 def get_ultimi_codici():
+    """Codici dell'ultimo lotto generato"""
+    lotto = archivio.ultimo_lotto()
+    if lotto:
+        return archivio.codici_lotto(lotto)
+    # Lotti generati prima dell'archivio SQLite
     if os.path.exists("ultimi_codici_generati.json"):
         with open("ultimi_codici_generati.json", "r", encoding="utf-8") as f:
             return json.load(f)
     else:
         return []
 
-def get_admin_stats():
-    """Calcola statistiche per il dashboard admin"""
-    codici = carica_codici()
-
-    total_codes = len(codici)
-    used_codes = sum(1 for c in codici.values() if c.get("usato", False))
-    completed_tests = sum(1 for c in codici.values() if c.get("usato", False) and c.get("report"))
+# Statistiche admin, tenute aggiornate in SQLite a ogni riscatto/report
+statistiche_admin = StatisticheAdmin()
 
-    usage_rate = round((used_codes / total_codes) * 100, 1) if total_codes > 0 else 0
-    completion_rate = round((completed_tests / used_codes) * 100, 1) if used_codes > 0 else 0
+# Norme per lotto/prefisso, costruite alla prima richiesta di ogni coorte
+norme_coorti = NormeCoorti()
+archivio.aggiungi_ascoltatore(norme_coorti.notifica)
 
-    return {
-        "total_codes": total_codes,
-        "used_codes": used_codes,
-        "completed_tests": completed_tests,
-        "available_codes": total_codes - used_codes,
-        "usage_rate": usage_rate,
-        "completion_rate": completion_rate
-    }
+def get_admin_stats():
+    """Calcola statistiche per il dashboard admin"""
+    return statistiche_admin.attuali()[1]
 
 def get_usage_trend():
     """Analizza il trend di utilizzo negli ultimi giorni"""
-    codici = carica_codici()
-    usage_by_date = {}
-
-    for seriale, info in codici.items():
-        if info.get("usato") and info.get("data"):
-            try:
-                date_str = info["data"].split(" ")[0]  # Prende solo la data
-                if date_str in usage_by_date:
-                    usage_by_date[date_str] += 1
-                else:
-                    usage_by_date[date_str] = 1
-            except:
-                continue
-
-    return usage_by_date
+    return statistiche_admin.attuali()[2]
 
 def get_scale_averages():
     """Calcola le medie per scala dai test completati"""
-    codici = carica_codici()
-    scale_scores = {}
-
-    for seriale, info in codici.items():
-        if info.get("report"):
-            for scala, dati in info["report"].items():
-                if scala not in scale_scores:
-                    scale_scores[scala] = []
-                scale_scores[scala].append(dati.get("punteggio_grezzo", 0))
-
-    # Calcola medie
-    scale_averages = {}
-    for scala, scores in scale_scores.items():
-        if scores:
-            scale_averages[scala] = round(np.mean(scores), 1)
-
-    return scale_averages
+    return statistiche_admin.attuali()[3]
 
 # ========== FINE UTILITY CODICI SERIALI ==========
 
-# Carica domande e struttura dal file json
-with open("data.json", "r", encoding="utf-8") as f:
-    test_structure = json.load(f)
-
-# Carica (o crea) il database storico dei risultati
-if os.path.exists("database.json"):
-    with open("database.json", "r", encoding="utf-8") as f:
-        database_storico = json.load(f)
-else:
-    database_storico = []
-
-def get_all_items():
-    items = []
-    for area in test_structure['areas']:
-        for scala in area['scales']:
-            for item in scala['items']:
-                items.append({
-                    "scala": scala['name'],
-                    "text": item['text'],
-                    "reverse": item['reverse']
-                })
-    return items
+# Domande e struttura compilate una volta sola (cache su file invalidata dall'hash).
+# Lo strumento predefinito è data.json; gli altri (strumenti/<id>.json) sono
+# compilati alla prima richiesta, vedi strumenti.py
+questionario = strumenti.questionario()
+
+def questionario_sessione():
+    """Questionario dello strumento assegnato al codice del candidato"""
+    return strumenti.questionario(session.get("strumento"))
+
+# Report e norme dei test completati vengono salvati in background, a
+# blocchi; all'avvio si riapplica quanto rimasto nel journal da un crash
+coda_completamenti = completamenti.Completamenti(strumenti.storico)
+coda_completamenti.compatta()
+
+# ========== METRICHE ==========
+# Durata di ogni richiesta per rotta; con ?_profilo=1 (solo admin) la
+# risposta viene sostituita dal riepilogo di cProfile della richiesta.
+archivio.aggiungi_ascoltatore(metriche.notifica)
+
+@app.before_request
+def inizio_richiesta():
+    g.inizio_richiesta = time.perf_counter()
+    # solo un admin può chiedere il profilo al posto della risposta; quelli
+    # campionati (PROFILO_CAMPIONAMENTO) vengono solo salvati in profili/
+    g.profilo_richiesto = bool(session.get("admin_logged")) and request.args.get("_profilo") == "1"
+    g.profilo = metriche.avvia_profilo(richiesto=g.profilo_richiesto)
+
+@app.after_request
+def fine_richiesta(risposta):
+    profilo = g.pop("profilo", None)
+    if profilo is not None:
+        riepilogo = metriche.ferma_profilo(profilo, request.endpoint or "sconosciuta")
+        if g.get("profilo_richiesto"):
+            risposta = Response(riepilogo, mimetype="text/plain; charset=utf-8")
+    if "inizio_richiesta" in g:
+        # registrata alla chiusura della risposta: per le rotte in streaming
+        # (esportazioni, /admin/api/dati) il lavoro avviene durante l'invio del corpo
+        metodo, rotta, inizio = request.method, _rotta(), g.pop("inizio_richiesta")
+        stato = risposta.status_code
+        risposta.call_on_close(lambda: metriche.registra_richiesta(
+            metodo, rotta, stato, time.perf_counter() - inizio))
+    return risposta
+
+@app.teardown_request
+def chiudi_richiesta(errore):
+    profilo = g.pop("profilo", None)
+    if profilo is not None:  # eccezione prima di after_request
+        metriche.ferma_profilo(profilo, request.endpoint or "sconosciuta")
+    if "inizio_richiesta" in g:  # after_request non eseguito: eccezione non gestita
+        metriche.registra_richiesta(request.method, _rotta(), 500,
+                                    time.perf_counter() - g.pop("inizio_richiesta"))
+
+def _rotta():
+    return request.url_rule.rule if request.url_rule else "<nessuna>"
 
 @app.route("/benvenuto")
 def benvenuto():
@@ -161,27 +139,25 @@ def login():
         nome = request.form["nome"].strip()
         email = request.form["email"].strip().lower()
         seriale = request.form["seriale"].strip().upper()
-        codici = carica_codici()
         if seriale == CODICE_MASTER:
             session["nome"] = nome
             session["email"] = email
             session["seriale"] = seriale
+            session["strumento"] = None
             return redirect(url_for('start'))
         if not nome or not email or not seriale:
             errore = "Compila tutti i campi"
-        elif seriale not in codici:
+        elif not archivio.esiste_codice(seriale):
             errore = "Il codice seriale non è valido. Contatta il referente."
-        elif codici[seriale]["usato"]:
+        elif not archivio.riscatta_codice(seriale, nome, email, datetime.now().strftime("%d/%m/%Y %H:%M")) \
+                and not archivio.riprendibile(seriale, email):
             errore = "Questo codice seriale è già stato utilizzato."
         else:
+            # codice appena riscattato, oppure test interrotto dalla stessa email: si riprende
             session["nome"] = nome
             session["email"] = email
             session["seriale"] = seriale
-            codici[seriale]["usato"] = True
-            codici[seriale]["email"] = email
-            codici[seriale]["nome"] = nome
-            codici[seriale]["data"] = datetime.now().strftime("%d/%m/%Y %H:%M")
-            salva_codici(codici)
+            session["strumento"] = archivio.strumento_codice(seriale)
             return redirect(url_for('start'))
     return render_template("login.html", errore=errore)
 
@@ -189,19 +165,41 @@ def login():
 def start():
     if not session.get("nome") or not session.get("email") or not session.get("seriale"):
         return redirect(url_for('login'))
-    session["answers"] = []
-    items = get_all_items()
-    session["items"] = items
-    return redirect(url_for('question', idx=0))
+    questionario = questionario_sessione()
+    answers = ""
+    if session["seriale"] != CODICE_MASTER:
+        progresso = archivio.leggi_progresso(session["seriale"])
+        if progresso and progresso[0] == questionario.versione:
+            answers = progresso[1]
+    session["answers"] = answers
+    session["versione"] = questionario.versione
+    session.pop("items", None)
+    if len(answers) >= len(questionario):
+        return redirect(url_for("result"))
+    return redirect(url_for('question', idx=len(answers)))
+
+def salva_progresso(questionario, answers):
+    """Checkpoint lato server delle risposte, per riprendere il test dopo una nuova login"""
+    session["answers"] = answers
+    if session["seriale"] != CODICE_MASTER:
+        archivio.salva_progresso(session["seriale"], questionario.versione, answers)
 
 @app.route("/question/<int:idx>", methods=["GET", "POST"])
 def question(idx):
-    items = session.get("items", get_all_items())
+    questionario = questionario_sessione()
+    if session.get("versione") != questionario.versione:
+        return redirect(url_for('start'))
+    items = questionario.items
+    if idx >= len(items):
+        abort(404)
     if request.method == "POST":
         answer = int(request.form["answer"])
-        answers = session.get("answers", [])
-        answers.append(answer)
-        session["answers"] = answers
+        if not risposta_valida(answer):
+            abort(400)
+        answers = imposta_risposte(session.get("answers", ""), idx, [answer])
+        if answers is None:
+            return redirect(url_for('question', idx=len(session.get("answers", ""))))
+        salva_progresso(questionario, answers)
         if idx + 1 < len(items):
             return redirect(url_for('question', idx=idx + 1))
         else:
@@ -209,62 +207,96 @@ def question(idx):
     item = items[idx]
     return render_template("question.html", idx=idx + 1, total=len(items), item=item)
 
+def _intero(valore):
+    """Intero JSON o stringa di cifre; niente float, booleani o altro."""
+    if isinstance(valore, int) and not isinstance(valore, bool):
+        return valore
+    if isinstance(valore, str) and valore.isascii() and valore.isdigit():
+        return int(valore)
+    raise ValueError(f"Non è un intero: {valore!r}")
+
+@app.route("/answers", methods=["POST"])
+def answers_batch():
+    """Salva in un'unica richiesta una pagina di risposte o l'intero questionario.
+
+    Corpo JSON: {"start": <indice del primo item>, "answers": [1-6, ...]}
+    (oppure "answers" come stringa di cifre).
+    """
+    if not session.get("seriale"):
+        return jsonify({"error": "Sessione non valida"}), 401
+    questionario = questionario_sessione()
+    if session.get("versione") != questionario.versione:
+        return jsonify({"error": "Sessione non valida"}), 401
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Formato risposte non valido"}), 400
+    try:
+        inizio = _intero(data.get("start", 0))
+        nuove = [_intero(r) for r in data.get("answers", [])]
+    except (TypeError, ValueError):
+        return jsonify({"error": "Formato risposte non valido"}), 400
+    if not nuove or not all(risposta_valida(r) for r in nuove) or inizio + len(nuove) > len(questionario):
+        return jsonify({"error": "Formato risposte non valido"}), 400
+    answers = imposta_risposte(session.get("answers", ""), inizio, nuove)
+    if answers is None:
+        return jsonify({"error": "Risposte non contigue"}), 409
+    salva_progresso(questionario, answers)
+    completo = len(answers) >= len(questionario)
+    return jsonify({
+        "next": len(answers),
+        "completo": completo,
+        "redirect": url_for("result") if completo else url_for("question", idx=len(answers))
+    })
+
 @app.route("/result")
 def result():
-    items = session.get("items", get_all_items())
-    answers = session.get("answers", [])
-    scores = {}
-    for i, ans in enumerate(answers):
-        scala = items[i]['scala']
-        rev = items[i]['reverse']
-        val = 7 - ans if rev else ans
-        scores.setdefault(scala, []).append(val)
-    sum_scores = {s: sum(v) for s, v in scores.items()}
-    for scala, score in sum_scores.items():
-        database_storico.append({"scala": scala, "score": score})
-    with open("database.json", "w", encoding="utf-8") as f:
-        json.dump(database_storico, f, ensure_ascii=False)
+    questionario = questionario_sessione()
+    if session.get("versione") != questionario.versione:
+        return redirect(url_for('start'))
+    items = questionario.items
+    answers = decodifica_risposte(session.get("answers", ""))[:len(items)]
+    with metriche.cronometro("result.punteggi"):
+        punteggi = questionario.punteggi_item(answers)
+        somme = questionario.punteggi_scale(answers)
+        presenti = questionario.scale_presenti(len(answers))
+        sum_scores = {scala: int(somme[i]) for i, scala in enumerate(questionario.scale) if presenti[i]}
     report = {}
-    for scala, score in sum_scores.items():
-        scores_scala = [x["score"] for x in database_storico if x["scala"] == scala]
-        percentile = int(round((np.sum(np.array(scores_scala) < score) / len(scores_scala)) * 100))
-        sorted_scores = sorted(scores_scala)
-        position = sorted_scores.index(score)
-        stanina = int(np.ceil(((position + 1) / len(sorted_scores)) * 9))
-        stanina = min(max(stanina, 1), 9)
-        report[scala] = {
-            "punteggio_grezzo": score,
-            "percentile": percentile,
-            "stanina": stanina
-        }
-    alert = False
-    ds = report.get("Desiderabilità sociale", {})
-    if ds and (ds.get("percentile", 0) >= 85 or ds.get("stanina", 0) >= 8):
-        alert = True
-    risposte_dettaglio = []
-    for i, ans in enumerate(answers):
-        item = items[i]
-        reverse = item['reverse']
-        punteggio = 7 - ans if reverse else ans
-        risposte_dettaglio.append({
+    with metriche.cronometro("result.percentili"):
+        storico = strumenti.storico(session.get("strumento"))
+        storico.aggiorna()
+        # un solo riferimento: una ricarica concorrente sostituisce l'indice intero
+        indice = storico.indice
+        for scala, score in sum_scores.items():
+            # il test entra nello storico quando il writer lo registra: qui conta già
+            percentile, stanina = indice.percentile_stanina(scala, score, nuovo=True)
+            report[scala] = {
+                "punteggio_grezzo": score,
+                "percentile": percentile,
+                "stanina": stanina
+            }
+    alert = norme.alert_desiderabilita(report)
+    risposte_dettaglio = [
+        {
             "idx": i + 1,
-            "text": item['text'],
-            "scala": item['scala'],
+            "text": items[i]['text'],
+            "scala": items[i]['scala'],
             "answer": ans,
-            "punteggio": punteggio,
-            "reverse": reverse
-        })
-    codici = carica_codici()
+            "punteggio": int(punteggi[i]),
+            "reverse": items[i]['reverse']
+        }
+        for i, ans in enumerate(answers)
+    ]
     seriale = session.get("seriale")
     email = session.get("email")
     print(f"SALVO SU {seriale} - {email}")
-    if seriale in codici:
-        codici[seriale]["risposte_dettaglio"] = risposte_dettaglio
-        codici[seriale]["report"] = report
-        salva_codici(codici)
-        print("SALVATO CORRETTAMENTE")
-    else:
-        print("SERIALE NON TROVATO, NON SALVO!")
+    with metriche.cronometro("result.accoda"):
+        coda_completamenti.accoda(
+            seriale, report, risposte_dettaglio,
+            ({"scala": scala, "score": score} for scala, score in sum_scores.items()),
+            strumento=session.get("strumento")
+        )
     return render_template(
         "result.html",
         report=report,
@@ -291,6 +323,8 @@ def admin_login():
             errore = "Credenziali errate."
     return render_template("admin_login.html", errore=errore)
 
+UTENTI_PER_PAGINA = 50
+
 @app.route("/admin_dashboard", methods=["GET", "POST"])
 def admin_dashboard():
     if not session.get("admin_logged"):
@@ -302,7 +336,7 @@ def admin_dashboard():
     if request.method == "POST" and "genera" in request.form:
         try:
             num_codici = int(request.form.get("num_codici", 50))
-            serials_list = genera_codici_batch(num_codici, "GO2B")
+            serials_list = genera_codici_batch(num_codici, "GO2B", request.form.get("strumento"))
             success_message = f"{num_codici} nuovi codici generati con successo!"
         except Exception as e:
             success_message = f"Errore nella generazione: {str(e)}"
@@ -312,50 +346,76 @@ def admin_dashboard():
     # Ottieni statistiche
     stats = get_admin_stats()
 
-    # Ottieni utenti
-    codici = carica_codici()
-    utenti = []
-    for s, info in codici.items():
-        if info["usato"]:
-            # Calcola se ha alert di desiderabilità sociale
-            has_alert = False
-            if info.get("report"):
-                ds = info["report"].get("Desiderabilità sociale", {})
-                has_alert = ds.get("percentile", 0) >= 85 or ds.get("stanina", 0) >= 8
-
-            utenti.append({
-                "nome": info["nome"],
-                "email": info["email"],
-                "seriale": s,
-                "data": info.get("data", ""),
-                "completed": bool(info.get("report")),
-                "has_alert": has_alert
-            })
-
-    # Ordina per data (più recenti prima)
-    utenti = sorted(utenti, key=lambda x: x.get("data", ""), reverse=True)
+    # Prima pagina degli utenti (più recenti prima); le successive via /admin/api/utenti
+    utenti, cursore_successivo = archivio.elenca_utenti(per_pagina=UTENTI_PER_PAGINA)
 
     return render_template("admin_dashboard_enhanced.html", 
                          utenti=utenti, 
                          serials_list=serials_list,
                          stats=stats,
+                         cursore_successivo=cursore_successivo,
                          success_message=success_message)
 
+@app.route("/admin/api/utenti")
+def admin_api_utenti():
+    """Elenco paginato dei candidati, filtrabile per email (prefisso), stato e alert"""
+    if not session.get("admin_logged"):
+        return jsonify({"error": "Non autorizzato"}), 401
+
+    per_pagina = min(max(request.args.get("per_pagina", UTENTI_PER_PAGINA, type=int), 1), 500)
+    stato = request.args.get("stato")
+    completato = {"completati": True, "in_corso": False}.get(stato)
+    alert = {"1": True, "0": False}.get(request.args.get("alert"))
+    try:
+        utenti, cursore_successivo = archivio.elenca_utenti(
+            per_pagina=per_pagina,
+            cursore=request.args.get("cursore"),
+            email=request.args.get("email", "").strip().lower() or None,
+            completato=completato,
+            alert=alert
+        )
+    except ValueError:
+        return jsonify({"error": "Cursore non valido"}), 400
+    return jsonify({"utenti": utenti, "cursore_successivo": cursore_successivo})
+
+@app.route("/admin/api/alert")
+def admin_api_alert():
+    """Candidati con alert di desiderabilità sociale (conteggio + pagina)"""
+    if not session.get("admin_logged"):
+        return jsonify({"error": "Non autorizzato"}), 401
+
+    per_pagina = min(max(request.args.get("per_pagina", UTENTI_PER_PAGINA, type=int), 1), 500)
+    try:
+        utenti, cursore_successivo = archivio.elenca_utenti(
+            per_pagina=per_pagina, cursore=request.args.get("cursore"), alert=True
+        )
+    except ValueError:
+        return jsonify({"error": "Cursore non valido"}), 400
+    return jsonify({
+        "totale": archivio.conta_alert(),
+        "utenti": utenti,
+        "cursore_successivo": cursore_successivo
+    })
+
 @app.route("/admin/api/stats")
 def admin_api_stats():
     """API endpoint per statistiche dashboard"""
     if not session.get("admin_logged"):
         return jsonify({"error": "Non autorizzato"}), 401
 
-    stats = get_admin_stats()
-    usage_trend = get_usage_trend()
-    scale_averages = get_scale_averages()
+    versione, stats, usage_trend, scale_averages = statistiche_admin.attuali()
+    etag = f"stats-{versione}"
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
 
-    return jsonify({
+    risposta = jsonify({
         "stats": stats,
         "usage_trend": usage_trend,
-        "scale_averages": scale_averages
+        "scale_averages": scale_averages,
+        "versione": versione
     })
+    risposta.set_etag(etag)
+    return risposta
 
 @app.route("/admin/api/generate_codes", methods=["POST"])
 def admin_api_generate_codes():
@@ -367,88 +427,173 @@ def admin_api_generate_codes():
         data = request.get_json()
         num_codici = data.get("num_codici", 50)
         prefix = data.get("prefix", "GO2B")
+        strumento = data.get("strumento")
 
-        nuovi_codici = genera_codici_batch(num_codici, prefix)
+        nuovi_codici = genera_codici_batch(num_codici, prefix, strumento)
 
         return jsonify({
             "success": True,
             "message": f"{num_codici} codici generati con successo",
             "codes": nuovi_codici
         })
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": f"Errore: {str(e)}"
+        }), 400
     except Exception as e:
         return jsonify({
             "success": False,
             "message": f"Errore: {str(e)}"
         }), 500
 
-@app.route("/admin/report/<email>/<seriale>")
-def admin_report(email, seriale):
+@app.route("/admin/api/strumenti")
+def admin_api_strumenti():
+    """Strumenti disponibili per i nuovi lotti di codici"""
     if not session.get("admin_logged"):
-        return redirect(url_for("admin_login"))
+        return jsonify({"error": "Non autorizzato"}), 401
 
-    codici = carica_codici()
-    user = codici.get(seriale)
-    if not user or user.get("email") != email:
-        return "Utente non trovato", 404
-    risposte_dettaglio = user.get("risposte_dettaglio", [])
-    report = user.get("report", {})
-    alert = False
-    ds = report.get("Desiderabilità sociale", {})
-    if ds and (ds.get("percentile", 0) >= 85 or ds.get("stanina", 0) >= 8):
-        alert = True
+    return jsonify({"strumenti": strumenti.elenco(), "predefinito": strumenti.PREDEFINITO})
+
+@app.route("/admin/api/coorte/<seriale>")
+def admin_api_coorte(seriale):
+    """Percentili e stanine del candidato rispetto al suo lotto (?tipo=lotto) o prefisso"""
+    if not session.get("admin_logged"):
+        return jsonify({"error": "Non autorizzato"}), 401
+
+    tipo = request.args.get("tipo", "lotto")
+    if tipo not in TIPI_COORTE:
+        return jsonify({"error": f"Tipo di coorte non valido: {tipo}"}), 400
+    info = archivio.leggi_codice(seriale)
+    if not info or not info.get("report"):
+        return jsonify({"error": "Report non trovato"}), 404
+
+    relativo = norme_coorti.report_relativo(seriale, info, tipo)
+    if relativo is None:
+        return jsonify({"error": "Codice senza lotto" if tipo == "lotto" else "Codice senza prefisso"}), 404
+    (_, coorte, strumento), numerosita, report = relativo
+    return jsonify({
+        "seriale": seriale,
+        "tipo": tipo,
+        "coorte": coorte,
+        "strumento": strumento or strumenti.PREDEFINITO,
+        "numerosita": numerosita,
+        "report": report
+    })
+
+@app.route("/admin/api/rinorma", methods=["GET", "POST"])
+def admin_api_rinorma():
+    """Avvia (POST) o interroga (GET) il ricalcolo di percentili/stanine dei report"""
+    if not session.get("admin_logged"):
+        return jsonify({"error": "Non autorizzato"}), 401
+
+    if request.method == "POST" and not rinorma.leggi_stato()["in_corso"]:
+        threading.Thread(target=rinorma.esegui_con_stato, args=(strumenti.storico,), daemon=True).start()
+    return jsonify(rinorma.leggi_stato())
+
+# Report renderizzati (HTML o JSON) per seriale + revisione della riga: un
+# report cambia revisione solo se viene riscritto (nuovo test, ricalcolo norme)
+REPORT_CACHE_MAX = 256
+cache_report = CacheLRU("report", REPORT_CACHE_MAX)
+
+def _non_modificato(etag, aggiornato):
+    """True se la richiesta condizionale del client ha già questa versione."""
+    if request.if_none_match:
+        return etag in request.if_none_match
+    return bool(aggiornato) and request.if_modified_since is not None \
+        and request.if_modified_since.timestamp() >= aggiornato
+
+def _corpo_report(seriale, user, formato):
+    if formato == "json":
+        return json.dumps({
+            "seriale": seriale,
+            "nome": user.get("nome", ""),
+            "email": user.get("email", ""),
+            "data_test": user.get("data", ""),
+            "alert": user["alert"],
+            "report": user.get("report", {}),
+            "risposte_dettaglio": user.get("risposte_dettaglio", [])
+        }, ensure_ascii=False)
     return render_template(
         "result.html",
-        report=report,
-        alert=alert,
+        report=user.get("report", {}),
+        alert=user["alert"],
         data_test=user.get("data", ""),
         nome=user.get("nome", ""),
         email=user.get("email", ""),
         seriale=seriale,
-        risposte_dettaglio=risposte_dettaglio
+        risposte_dettaglio=user.get("risposte_dettaglio", [])
     )
 
+@app.route("/admin/report/<email>/<seriale>")
+def admin_report(email, seriale):
+    """Report di un candidato (HTML, o JSON con ?formato=json), con ETag/Last-Modified"""
+    if not session.get("admin_logged"):
+        return redirect(url_for("admin_login"))
+
+    formato = "json" if request.args.get("formato") == "json" else "html"
+    testata = archivio.revisione_codice(seriale)
+    if not testata or testata[0] != email:
+        return "Utente non trovato", 404
+    _, revisione, aggiornato = testata
+    etag = f"report-{seriale}-{revisione}-{formato}"
+    if _non_modificato(etag, aggiornato):
+        risposta = Response(status=304)
+    else:
+        corpo = cache_report.leggi((seriale, revisione, formato))
+        if corpo is None:
+            user = archivio.leggi_codice(seriale)
+            # la riga può essere cambiata dopo la lettura della testata: vale la sua revisione
+            revisione, aggiornato = user["revisione"], user["aggiornato"]
+            etag = f"report-{seriale}-{revisione}-{formato}"
+            corpo = _corpo_report(seriale, user, formato)
+            cache_report.scrivi((seriale, revisione, formato), corpo)
+        mimetype = "application/json" if formato == "json" else "text/html"
+        risposta = Response(corpo, mimetype=mimetype)
+    risposta.set_etag(etag)
+    if aggiornato:
+        risposta.last_modified = datetime.fromtimestamp(aggiornato, timezone.utc)
+    # dati personali: solo cache del browser, sempre rivalidata
+    risposta.cache_control.private = True
+    risposta.cache_control.no_cache = True
+    return risposta
+
+def scale_esportazioni():
+    """Scale di tutti gli strumenti con report salvati, nell'ordine dei questionari"""
+    scale = list(questionario.scale)
+    for strumento in archivio.strumenti_usati():
+        if strumento and strumenti.esiste(strumento):
+            scale.extend(s for s in strumenti.questionario(strumento).scale if s not in scale)
+    return scale
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Job di esportazione in background, con file in cache per versione dei dati
+coda_esportazioni = esportazioni.CodaEsportazioni()
+
+def _scrittore_esportazione(tipo):
+    """Funzione che scrive il workbook `tipo` su un percorso."""
+    if tipo == "users":
+        return esportazioni.scrivi_utenti_xlsx
+    if tipo == "codes":
+        codici_recenti = get_ultimi_codici()
+        return lambda percorso: esportazioni.scrivi_codici_xlsx(percorso, codici_recenti)
+    if tipo == "results":
+        return lambda percorso: esportazioni.scrivi_risultati_xlsx(percorso, scale_esportazioni())
+    return None
+
+def _invia_esportazione(tipo, nome_file):
+    """Invia il workbook: dalla cache se la versione dei dati è invariata, altrimenti lo genera in cache."""
+    pronto = coda_esportazioni.genera(tipo, archivio.versione_dati(), _scrittore_esportazione(tipo))
+    return send_file(pronto, as_attachment=True, download_name=nome_file, mimetype=XLSX_MIMETYPE)
+
 @app.route("/admin/export/users")
 def admin_export_users():
     """Esporta lista utenti in Excel"""
     if not session.get("admin_logged"):
         return redirect(url_for("admin_login"))
 
-    codici = carica_codici()
-    output = io.BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-    worksheet = workbook.add_worksheet("Utenti")
-
-    # Headers
-    headers = ["Nome", "Email", "Codice Seriale", "Data Test", "Test Completato", "Alert Desiderabilità"]
-    for col, header in enumerate(headers):
-        worksheet.write(0, col, header)
-
-    # Data
-    row = 1
-    for seriale, info in codici.items():
-        if info.get("usato"):
-            has_alert = False
-            if info.get("report"):
-                ds = info["report"].get("Desiderabilità sociale", {})
-                has_alert = ds.get("percentile", 0) >= 85 or ds.get("stanina", 0) >= 8
-
-            worksheet.write(row, 0, info.get("nome", ""))
-            worksheet.write(row, 1, info.get("email", ""))
-            worksheet.write(row, 2, seriale)
-            worksheet.write(row, 3, info.get("data", ""))
-            worksheet.write(row, 4, "Sì" if info.get("report") else "No")
-            worksheet.write(row, 5, "Sì" if has_alert else "No")
-            row += 1
-
-    workbook.close()
-    output.seek(0)
-
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f"utenti_go2b_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+    return _invia_esportazione("users", f"utenti_go2b_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx")
 
 @app.route("/admin/export/codes")
 def admin_export_codes():
@@ -456,114 +601,129 @@ def admin_export_codes():
     if not session.get("admin_logged"):
         return redirect(url_for("admin_login"))
 
-    codici_recenti = get_ultimi_codici()
-    output = io.BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-    worksheet = workbook.add_worksheet("Codici")
-
-    # Headers
-    worksheet.write(0, 0, "Codice Seriale")
-    worksheet.write(0, 1, "Stato")
-
-    # Data
-    codici_db = carica_codici()
-    for idx, code in enumerate(codici_recenti):
-        worksheet.write(idx + 1, 0, code)
-        stato = "Utilizzato" if codici_db.get(code, {}).get("usato") else "Disponibile"
-        worksheet.write(idx + 1, 1, stato)
-
-    workbook.close()
-    output.seek(0)
-
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f"codici_go2b_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+    return _invia_esportazione("codes", f"codici_go2b_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx")
+
+@app.route("/admin/export/<tipo>/job", methods=["POST"])
+def admin_export_job(tipo):
+    """Avvia in background l'esportazione `tipo` (users, codes, results)"""
+    if not session.get("admin_logged"):
+        return jsonify({"error": "Non autorizzato"}), 401
+
+    scrivi = _scrittore_esportazione(tipo)
+    if scrivi is None:
+        return jsonify({"error": "Tipo di esportazione sconosciuto"}), 404
+    job_id = coda_esportazioni.avvia(tipo, archivio.versione_dati(), scrivi)
+    return jsonify(dict(
+        coda_esportazioni.stato(job_id),
+        url_stato=url_for("admin_export_job_stato", job_id=job_id)
+    )), 202
+
+@app.route("/admin/export/job/<job_id>")
+def admin_export_job_stato(job_id):
+    """Stato di un job di esportazione (per il polling dal dashboard)"""
+    if not session.get("admin_logged"):
+        return jsonify({"error": "Non autorizzato"}), 401
+
+    stato = coda_esportazioni.stato(job_id)
+    if stato is None:
+        return jsonify({"error": "Job non trovato"}), 404
+    if stato["stato"] == "pronto":
+        stato["url_download"] = url_for("admin_export_job_download", job_id=job_id)
+    return jsonify(stato)
+
+@app.route("/admin/export/job/<job_id>/download")
+def admin_export_job_download(job_id):
+    if not session.get("admin_logged"):
+        return redirect(url_for("admin_login"))
+
+    pronto = coda_esportazioni.file_pronto(job_id)
+    if not pronto:
+        return "Esportazione non disponibile", 404
+    tipo = job_id.rsplit("-", 1)[0]
+    return send_file(pronto, as_attachment=True, download_name=f"{tipo}_go2b_{job_id.rsplit('-', 1)[1]}.xlsx",
+                     mimetype=XLSX_MIMETYPE)
 
 @app.route("/admin/export/results")
 def admin_export_results():
-    """Esporta risultati completi in Excel"""
+    """Esporta risultati completi in Excel (o CSV/NDJSON con ?formato=)"""
     if not session.get("admin_logged"):
         return redirect(url_for("admin_login"))
 
-    codici = carica_codici()
-    output = io.BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-
-    # Foglio riassuntivo
-    summary_ws = workbook.add_worksheet("Riassunto")
-    headers = ["Nome", "Email", "Data Test"]
-
-    # Aggiungi headers per tutte le scale
-    scale_names = []
-    for seriale, info in codici.items():
-        if info.get("report"):
-            for scala in info["report"].keys():
-                if scala not in scale_names:
-                    scale_names.append(scala)
-
-    for scala in scale_names:
-        headers.extend([f"{scala} - Punteggio", f"{scala} - Percentile", f"{scala} - Stanina"])
-
-    for col, header in enumerate(headers):
-        summary_ws.write(0, col, header)
-
-    # Dati riassuntivi
-    row = 1
-    for seriale, info in codici.items():
-        if info.get("report"):
-            col = 0
-            summary_ws.write(row, col, info.get("nome", ""))
-            col += 1
-            summary_ws.write(row, col, info.get("email", ""))
-            col += 1
-            summary_ws.write(row, col, info.get("data", ""))
-            col += 1
-
-            for scala in scale_names:
-                if scala in info["report"]:
-                    dati = info["report"][scala]
-                    summary_ws.write(row, col, dati.get("punteggio_grezzo", ""))
-                    summary_ws.write(row, col + 1, dati.get("percentile", ""))
-                    summary_ws.write(row, col + 2, dati.get("stanina", ""))
-                col += 3
-            row += 1
-
-    # Foglio dettagli risposte
-    detail_ws = workbook.add_worksheet("Dettaglio Risposte")
-    detail_headers = ["Nome", "Email", "Domanda", "Scala", "Risposta", "Punteggio", "Inversa"]
-    for col, header in enumerate(detail_headers):
-        detail_ws.write(0, col, header)
-
-    detail_row = 1
-    for seriale, info in codici.items():
-        if info.get("risposte_dettaglio"):
-            for risposta in info["risposte_dettaglio"]:
-                detail_ws.write(detail_row, 0, info.get("nome", ""))
-                detail_ws.write(detail_row, 1, info.get("email", ""))
-                detail_ws.write(detail_row, 2, risposta.get("text", ""))
-                detail_ws.write(detail_row, 3, risposta.get("scala", ""))
-                detail_ws.write(detail_row, 4, risposta.get("answer", ""))
-                detail_ws.write(detail_row, 5, risposta.get("punteggio", ""))
-                detail_ws.write(detail_row, 6, "Sì" if risposta.get("reverse") else "No")
-                detail_row += 1
-
-    workbook.close()
-    output.seek(0)
-
-    return send_file(
-        output,
-        as_attachment=True,
-        download_name=f"risultati_completi_go2b_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    formato = request.args.get("formato", "xlsx")
+    nome_file = f"risultati_completi_go2b_{datetime.now().strftime('%Y%m%d_%H%M')}"
+    if formato == "csv":
+        corpo = esportazioni.stream_risultati_csv(scale_esportazioni())
+        mimetype = "text/csv; charset=utf-8"
+    elif formato == "ndjson":
+        corpo = esportazioni.stream_risultati_ndjson()
+        mimetype = "application/x-ndjson; charset=utf-8"
+    else:
+        return _invia_esportazione("results", f"{nome_file}.xlsx")
+
+    return Response(
+        corpo,
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={nome_file}.{formato}"}
+    )
+
+def admin_autorizzato():
+    """Sessione admin oppure credenziali admin in HTTP Basic (client automatici)"""
+    credenziali = request.authorization
+    basic_valida = bool(credenziali) and credenziali.username == ADMIN_USER and credenziali.password == ADMIN_PASS
+    return bool(session.get("admin_logged")) or basic_valida
+
+FORMATI_DATI = {
+    "ndjson": esportazioni.stream_dati_ndjson,
+    "colonne": esportazioni.stream_dati_colonne,
+}
+
+@app.route("/admin/api/dati")
+def admin_api_dati():
+    """Report e risposte dei test completati, in streaming, per la sincronizzazione incrementale.
+
+    ?updated_since=<cursore> restituisce solo i codici modificati dopo il
+    cursore; il cursore da usare la volta successiva è nell'header X-Cursore.
+    ?formato=ndjson (un codice per riga) o colonne (blocchi colonnari).
+    """
+    if not admin_autorizzato():
+        return Response("Non autorizzato", status=401, headers={"WWW-Authenticate": 'Basic realm="dati"'})
+
+    formato = request.args.get("formato", "ndjson")
+    if formato not in FORMATI_DATI:
+        return jsonify({"error": f"Formato non valido: {formato}"}), 400
+    try:
+        dopo = int(request.args.get("updated_since", -1))
+    except ValueError:
+        return jsonify({"error": "Cursore non valido"}), 400
+    # 0 = dall'inizio, comprese le righe mai modificate dalla migrazione (revisione 0)
+    dopo = dopo if dopo > 0 else -1
+    fino = archivio.versione_dati()
+
+    return Response(
+        FORMATI_DATI[formato](dopo, fino),
+        mimetype="application/x-ndjson; charset=utf-8",
+        headers={"X-Cursore": str(fino), "Cache-Control": "no-store"}
     )
 
+@app.route("/admin/metrics")
+def admin_metrics():
+    """Metriche in formato testo Prometheus (sessione admin o HTTP Basic)"""
+    if not admin_autorizzato():
+        return Response("Non autorizzato", status=401, headers={"WWW-Authenticate": 'Basic realm="metriche"'})
+
+    testo = metriche.testo_prometheus(valori={
+        "bip_avvio_ms": TEMPO_AVVIO_MS,
+        "bip_versione_dati": archivio.versione_dati()
+    })
+    return Response(testo, mimetype="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route("/admin/logout")
 def admin_logout():
     session.pop("admin_logged", None)
     return redirect(url_for("admin_login"))
 
+TEMPO_AVVIO_MS = round((time.perf_counter() - _inizio_avvio) * 1000, 1)
+print(f"Avvio applicazione completato in {TEMPO_AVVIO_MS} ms")
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080, debug=True)
\ No newline at end of file
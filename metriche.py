@@ -0,0 +1,261 @@
+"""Metriche di processo esposte in formato testo Prometheus.
+
+Contatori e istogrammi di durata sono tenuti in memoria da ciascun processo
+(costo: un lock e un paio di operazioni su dizionario per osservazione).
+Con più worker gunicorn ogni processo salva ogni INTERVALLO_SALVATAGGIO
+secondi un'istantanea in metriche_cache/<pid>.json e l'endpoint somma
+quelle dei worker ancora vivi, così lo scrape non dipende dal worker che
+risponde.
+
+Il profiler (cProfile) si attiva per singola richiesta: su richiesta
+esplicita di un admin oppure su una frazione casuale delle richieste
+(variabile PROFILO_CAMPIONAMENTO, 0 per default). I profili vengono salvati
+in profili/ come file .prof.
+"""
+import bisect
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from blocchi import processo_vivo
+
+CARTELLA = "metriche_cache"
+CARTELLA_PROFILI = "profili"
+INTERVALLO_SALVATAGGIO = 5  # secondi
+MAX_PROFILI = 200
+BUCKET = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CAMPIONAMENTO_PROFILO = float(os.environ.get("PROFILO_CAMPIONAMENTO", "0"))
+
+DESCRIZIONI = {
+    "bip_richieste_totale": ("counter", "Richieste HTTP servite per rotta, metodo e stato"),
+    "bip_richiesta_secondi": ("histogram", "Durata delle richieste HTTP per rotta"),
+    "bip_operazione_secondi": ("histogram", "Durata delle operazioni di I/O e delle fasi di calcolo"),
+    "bip_operazione_byte_totale": ("counter", "Byte letti o scritti dalle operazioni di I/O"),
+    "bip_codici_riscattati_totale": ("counter", "Codici seriali riscattati"),
+    "bip_test_completati_totale": ("counter", "Test completati (primo report salvato per il codice)"),
+    "bip_cache_totale": ("counter", "Letture dalle cache in memoria per esito (hit/miss)"),
+    "bip_avvio_ms": ("gauge", "Tempo di avvio del worker che risponde, in millisecondi"),
+    "bip_versione_dati": ("gauge", "Versione corrente dei dati dell'archivio"),
+}
+
+
+class Registro:
+    """Contatori e istogrammi indicizzati per (nome, etichette)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contatori = {}
+        self._istogrammi = {}
+        self._ultimo_salvataggio = 0.0
+
+    def incrementa(self, nome, valore=1, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock:
+            self._contatori[chiave] = self._contatori.get(chiave, 0) + valore
+
+    def osserva(self, nome, secondi, **etichette):
+        chiave = (nome, tuple(sorted(etichette.items())))
+        with self._lock:
+            valori = self._istogrammi.get(chiave)
+            if valori is None:
+                # conteggio per bucket (+Inf compreso), somma, numero di osservazioni
+                valori = self._istogrammi[chiave] = [0] * (len(BUCKET) + 1) + [0.0, 0]
+            valori[bisect.bisect_left(BUCKET, secondi)] += 1
+            valori[-2] += secondi
+            valori[-1] += 1
+
+    def istantanea(self):
+        with self._lock:
+            return {
+                "contatori": [[n, list(map(list, e)), v] for (n, e), v in self._contatori.items()],
+                "istogrammi": [[n, list(map(list, e)), list(v)] for (n, e), v in self._istogrammi.items()],
+            }
+
+    def salva(self, cartella=CARTELLA, forza=False):
+        """Scrive l'istantanea del processo (al più ogni INTERVALLO_SALVATAGGIO secondi)."""
+        adesso = time.monotonic()
+        if not forza and adesso - self._ultimo_salvataggio < INTERVALLO_SALVATAGGIO:
+            return
+        self._ultimo_salvataggio = adesso
+        os.makedirs(cartella, exist_ok=True)
+        percorso = os.path.join(cartella, f"{os.getpid()}.json")
+        temporaneo = f"{percorso}.{threading.get_ident()}.tmp"
+        with open(temporaneo, "w", encoding="utf-8") as f:
+            json.dump(self.istantanea(), f)
+        os.replace(temporaneo, percorso)
+
+
+registro = Registro()
+
+
+class _Misura:
+    byte = 0
+
+
+@contextmanager
+def cronometro(operazione):
+    """Misura la durata del blocco; il blocco può assegnare `misura.byte`."""
+    misura = _Misura()
+    inizio = time.perf_counter()
+    try:
+        yield misura
+    finally:
+        registro.osserva("bip_operazione_secondi", time.perf_counter() - inizio, operazione=operazione)
+        if misura.byte:
+            registro.incrementa("bip_operazione_byte_totale", misura.byte, operazione=operazione)
+
+
+def registra_richiesta(metodo, rotta, stato, secondi):
+    registro.incrementa("bip_richieste_totale", metodo=metodo, rotta=rotta, stato=str(stato))
+    registro.osserva("bip_richiesta_secondi", secondi, rotta=rotta)
+    registro.salva()
+
+
+def notifica(evento, versione, dati):
+    """Ascoltatore di archivio: conta riscatti e completamenti."""
+    if evento == "riscatto":
+        registro.incrementa("bip_codici_riscattati_totale")
+    elif evento == "report":
+        nuovi = sum(1 for voce in dati["voci"] if voce["report"] and not voce["precedente"])
+        if nuovi:
+            registro.incrementa("bip_test_completati_totale", nuovi)
+
+
+# ========== ESPOSIZIONE ==========
+
+def _istantanee(cartella):
+    """Istantanee dei processi vivi; i file dei worker terminati vengono rimossi."""
+    registro.salva(cartella, forza=True)
+    for nome in os.listdir(cartella):
+        if not nome.endswith(".json"):
+            continue
+        percorso = os.path.join(cartella, nome)
+        try:
+            pid = int(nome[:-len(".json")])
+        except ValueError:
+            continue
+        if not processo_vivo(pid):
+            try:
+                os.remove(percorso)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(percorso, "r", encoding="utf-8") as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def _escape(valore):
+    return str(valore).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etichette(coppie):
+    if not coppie:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in coppie) + "}"
+
+
+def _numero(valore):
+    return repr(float(valore)) if isinstance(valore, float) else str(valore)
+
+
+def testo_prometheus(cartella=CARTELLA, valori=None):
+    """Metriche di tutti i worker in formato testo Prometheus.
+
+    `valori` aggiunge gauge calcolati al momento ({nome: valore}).
+    """
+    contatori = {}
+    istogrammi = {}
+    for istantanea in _istantanee(cartella):
+        for nome, etichette, valore in istantanea["contatori"]:
+            chiave = (nome, tuple(map(tuple, etichette)))
+            contatori[chiave] = contatori.get(chiave, 0) + valore
+        for nome, etichette, conteggi in istantanea["istogrammi"]:
+            chiave = (nome, tuple(map(tuple, etichette)))
+            somma = istogrammi.setdefault(chiave, [0] * len(conteggi))
+            for i, c in enumerate(conteggi):
+                somma[i] += c
+
+    righe = []
+    descritti = set()
+
+    def intestazione(nome):
+        if nome not in descritti:
+            descritti.add(nome)
+            tipo, aiuto = DESCRIZIONI.get(nome, ("untyped", nome))
+            righe.append(f"# HELP {nome} {aiuto}")
+            righe.append(f"# TYPE {nome} {tipo}")
+
+    for (nome, coppie), valore in sorted(contatori.items()):
+        intestazione(nome)
+        righe.append(f"{nome}{_etichette(coppie)} {_numero(valore)}")
+    for (nome, coppie), conteggi in sorted(istogrammi.items()):
+        intestazione(nome)
+        cumulato = 0
+        for limite, c in zip(BUCKET + ("+Inf",), conteggi):
+            cumulato += c
+            righe.append(f"{nome}_bucket{_etichette(coppie + (('le', str(limite)),))} {cumulato}")
+        righe.append(f"{nome}_sum{_etichette(coppie)} {_numero(float(conteggi[-2]))}")
+        righe.append(f"{nome}_count{_etichette(coppie)} {conteggi[-1]}")
+    for nome, valore in (valori or {}).items():
+        intestazione(nome)
+        righe.append(f"{nome} {_numero(valore)}")
+    return "\n".join(righe) + "\n"
+
+
+# ========== PROFILER ==========
+# cProfile non supporta più profili attivi insieme: uno per processo alla volta,
+# le altre richieste campionate nel frattempo vengono semplicemente saltate.
+_profilo_lock = threading.Lock()
+
+
+def avvia_profilo(richiesto=False):
+    """Attiva cProfile per la richiesta corrente se richiesto o campionato; None altrimenti."""
+    if not richiesto and not (CAMPIONAMENTO_PROFILO and random.random() < CAMPIONAMENTO_PROFILO):
+        return None
+    if not _profilo_lock.acquire(blocking=False):
+        return None
+    profilo = cProfile.Profile()
+    try:
+        profilo.enable()
+    except ValueError:  # un altro profiler (debugger) è già attivo
+        _profilo_lock.release()
+        return None
+    return profilo
+
+
+def ferma_profilo(profilo, nome, righe=40):
+    """Ferma il profilo, lo salva in profili/ e ne restituisce il riepilogo testuale."""
+    profilo.disable()
+    _profilo_lock.release()
+    os.makedirs(CARTELLA_PROFILI, exist_ok=True)
+    nome = "".join(c if c.isalnum() else "_" for c in nome).strip("_") or "radice"
+    percorso = os.path.join(
+        CARTELLA_PROFILI, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{nome}.prof"
+    )
+    profilo.dump_stats(percorso)
+    _pulisci_profili()
+    testo = io.StringIO()
+    pstats.Stats(profilo, stream=testo).sort_stats("cumulative").print_stats(righe)
+    return testo.getvalue()
+
+
+def _pulisci_profili():
+    """Tiene solo gli ultimi MAX_PROFILI file."""
+    try:
+        nomi = sorted(n for n in os.listdir(CARTELLA_PROFILI) if n.endswith(".prof"))
+    except OSError:
+        return
+    for nome in nomi[:-MAX_PROFILI]:
+        try:
+            os.remove(os.path.join(CARTELLA_PROFILI, nome))
+        except OSError:
+            pass
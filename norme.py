@@ -0,0 +1,276 @@
+"""Storico normativo e indice incrementale per percentili/stanine.
+
+I punteggi grezzi di scala sono piccoli interi limitati, quindi per ogni
+scala basta un istogramma dei conteggi: l'inserimento è O(1) e il calcolo
+di percentile e stanina non dipende dalla dimensione del gruppo normativo.
+Lo storico è persistito in append su un journal JSONL (database.jsonl);
+database.json è lo snapshot, riscritto in modo atomico solo quando il
+journal supera SOGLIA_COMPATTAZIONE record. All'avvio lo storico in memoria
+viene ricostruito da snapshot + coda del journal.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+import metriche
+from blocchi import blocco_file
+
+DATABASE_FILE = "database.json"
+JOURNAL_FILE = "database.jsonl"
+SOGLIA_COMPATTAZIONE = 5000
+
+
+class IndiceNorme:
+    """Istogramma dei punteggi grezzi per ciascuna scala."""
+
+    def __init__(self):
+        self._conteggi = {}
+        self._totali = {}
+        self._lock = threading.Lock()
+
+    def aggiungi(self, scala, score):
+        score = int(score)
+        with self._lock:
+            conteggi = self._conteggi.get(scala)
+            if conteggi is None or score >= len(conteggi):
+                nuovi = np.zeros(max(score + 1, 64), dtype=np.int64)
+                if conteggi is not None:
+                    nuovi[:len(conteggi)] = conteggi
+                conteggi = self._conteggi[scala] = nuovi
+            conteggi[score] += 1
+            self._totali[scala] = self._totali.get(scala, 0) + 1
+
+    def rimuovi(self, scala, score):
+        """Toglie un punteggio aggiunto in precedenza (report riscritto)."""
+        score = int(score)
+        with self._lock:
+            conteggi = self._conteggi.get(scala)
+            if conteggi is None or score >= len(conteggi) or not conteggi[score]:
+                return
+            conteggi[score] -= 1
+            self._totali[scala] -= 1
+
+    def totale(self, scala):
+        return self._totali.get(scala, 0)
+
+    def percentile_stanina(self, scala, score, nuovo=False):
+        """Percentile e stanina di `score` rispetto alla scala.
+
+        Stessa definizione usata finora in result(): percentile = quota di
+        punteggi strettamente inferiori, stanina dalla posizione del primo
+        punteggio uguale nella distribuzione ordinata. Con `nuovo` il
+        punteggio non è ancora nello storico e viene contato come se lo fosse.
+        """
+        with self._lock:
+            totale = self._totali.get(scala, 0) + (1 if nuovo else 0)
+            if not totale:
+                return 0, 1
+            conteggi = self._conteggi.get(scala)
+            inferiori = int(conteggi[:max(int(score), 0)].sum()) if conteggi is not None else 0
+        percentile = int(round(inferiori / totale * 100))
+        stanina = int(np.ceil(((inferiori + 1) / totale) * 9))
+        return percentile, min(max(stanina, 1), 9)
+
+    def percentili_stanine(self, scala, scores):
+        """Versione vettoriale di percentile_stanina per un array di punteggi."""
+        scores = np.clip(np.asarray(scores, dtype=np.int64), 0, None)
+        with self._lock:
+            totale = self._totali.get(scala, 0)
+            if not totale:
+                return np.zeros(len(scores), dtype=np.int64), np.ones(len(scores), dtype=np.int64)
+            cumulati = np.concatenate(([0], np.cumsum(self._conteggi[scala])))
+        inferiori = cumulati[np.minimum(scores, len(cumulati) - 1)]
+        percentili = np.rint(inferiori / totale * 100).astype(np.int64)
+        stanine = np.ceil((inferiori + 1) / totale * 9).astype(np.int64)
+        return percentili, np.clip(stanine, 1, 9)
+
+
+class StoricoNorme:
+    """Record {"scala", "score"} dello storico con il relativo indice.
+
+    Ogni riga del journal porta "n", la posizione del record nello storico:
+    se un crash avviene dopo aver scritto lo snapshot ma prima di svuotare
+    il journal, le righe già incluse nello snapshot vengono saltate. I record
+    registrati da un completamento portano anche "c", il suo id: lo stesso
+    completamento non viene mai registrato due volte.
+
+    Più processi possono condividere gli stessi file: le scritture avvengono
+    sotto lock esclusivo (database.jsonl.lock) dopo essersi allineati alla
+    coda del journal, e aggiorna() legge solo le righe aggiunte da altri
+    processi, o ricarica tutto se nel frattempo è stato scritto un nuovo
+    snapshot.
+    """
+
+    def __init__(self, database_file=DATABASE_FILE, journal_file=JOURNAL_FILE,
+                 soglia_compattazione=SOGLIA_COMPATTAZIONE):
+        self.database_file = database_file
+        self.journal_file = journal_file
+        self.lock_file = journal_file + ".lock"
+        self.soglia_compattazione = soglia_compattazione
+        self.record = []
+        self.indice = IndiceNorme()
+        self.completamenti = set()
+        self._nel_journal = 0
+        self._offset = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def carica(self):
+        """Ricostruisce lo storico da snapshot (database.json) + journal."""
+        with self._lock, blocco_file(self.lock_file, esclusivo=False):
+            self._ricarica()
+        return self
+
+    def aggiorna(self):
+        """Applica le modifiche fatte da altri processi (costa due stat se non ce ne sono)."""
+        with self._lock:
+            if self._invariato():
+                return
+            with blocco_file(self.lock_file, esclusivo=False):
+                self._allinea()
+
+    def _identita_snapshot(self):
+        try:
+            st = os.stat(self.database_file)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _dimensione_journal(self):
+        try:
+            return os.path.getsize(self.journal_file)
+        except FileNotFoundError:
+            return 0
+
+    def _invariato(self):
+        return (self._identita_snapshot() == self._snapshot
+                and self._dimensione_journal() == self._offset)
+
+    def _allinea(self):
+        if self._identita_snapshot() != self._snapshot or self._dimensione_journal() < self._offset:
+            self._ricarica()
+        else:
+            self._leggi_journal()
+
+    def _ricarica(self):
+        """Ricostruisce lo storico da capo e lo sostituisce a quello in memoria.
+
+        Chi legge `self.indice` senza lock (result()) vede il vecchio indice
+        o quello nuovo completo, mai un istogramma costruito a metà.
+        """
+        nuovo = StoricoNorme(self.database_file, self.journal_file, self.soglia_compattazione)
+        nuovo._snapshot = nuovo._identita_snapshot()
+        if nuovo._snapshot is not None:
+            with metriche.cronometro("norme.carica_snapshot") as misura, \
+                    open(self.database_file, "r", encoding="utf-8") as f:
+                nuovo._applica(json.load(f))
+                misura.byte = nuovo._snapshot[2]
+        nuovo._leggi_journal()
+        self.record, self.indice, self.completamenti = nuovo.record, nuovo.indice, nuovo.completamenti
+        self._nel_journal, self._offset, self._snapshot = nuovo._nel_journal, nuovo._offset, nuovo._snapshot
+
+    def _leggi_journal(self):
+        """Legge il journal da dove ci si era fermati; si ferma su una riga incompleta."""
+        if not os.path.exists(self.journal_file):
+            return
+        with metriche.cronometro("norme.leggi_journal") as misura, open(self.journal_file, "rb") as f:
+            f.seek(self._offset)
+            inizio = self._offset
+            for riga in f:
+                if not riga.endswith(b"\n"):
+                    break  # scrittura interrotta: la riga incompleta si scarta
+                try:
+                    r = json.loads(riga)
+                except ValueError:
+                    break
+                self._offset += len(riga)
+                self._nel_journal += 1
+                n = r.pop("n", len(self.record))
+                if n >= len(self.record):
+                    self._applica([r])
+            misura.byte = self._offset - inizio
+
+    def _applica(self, record):
+        for r in record:
+            self.record.append(r)
+            self.indice.aggiungi(r["scala"], r["score"])
+            if "c" in r:
+                self.completamenti.add(r["c"])
+
+    def registra_completamenti(self, completamenti):
+        """Registra più test, (id, record), con una sola append; restituisce gli id registrati.
+
+        Gli id già presenti nello storico vengono saltati; id None non viene
+        controllato né salvato.
+        """
+        with self._lock, blocco_file(self.lock_file):
+            self._allinea()
+            record = []
+            registrati = []
+            for completamento, voci in completamenti:
+                if completamento is None:
+                    record.extend(voci)
+                elif completamento not in self.completamenti and completamento not in registrati:
+                    record.extend(dict(r, c=completamento) for r in voci)
+                    registrati.append(completamento)
+            if not record:
+                return registrati
+            if self._dimensione_journal() > self._offset:
+                # resto di una scrittura interrotta da un crash: si elimina
+                with open(self.journal_file, "r+b") as f:
+                    f.truncate(self._offset)
+            base = len(self.record)
+            righe = "".join(
+                json.dumps(dict(r, n=base + i), ensure_ascii=False) + "\n"
+                for i, r in enumerate(record)
+            )
+            dati = righe.encode("utf-8")
+            with metriche.cronometro("norme.append_journal") as misura, open(self.journal_file, "ab") as f:
+                f.write(dati)
+                f.flush()
+                os.fsync(f.fileno())
+                self._offset = f.tell()
+                misura.byte = len(dati)
+            self._applica(record)
+            self._nel_journal += len(record)
+            if self._nel_journal >= self.soglia_compattazione:
+                self._compatta()
+            return registrati
+
+    def compatta(self):
+        """Scrive lo snapshot completo e svuota il journal."""
+        with self._lock, blocco_file(self.lock_file):
+            self._allinea()
+            self._compatta()
+
+    def _compatta(self):
+        temporaneo = self.database_file + ".tmp"
+        with metriche.cronometro("norme.scrivi_snapshot") as misura, open(temporaneo, "w", encoding="utf-8") as f:
+            json.dump(self.record, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+            misura.byte = f.tell()
+        os.replace(temporaneo, self.database_file)
+        with open(self.journal_file, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._nel_journal = 0
+        self._offset = 0
+        self._snapshot = self._identita_snapshot()
+
+
+# ========== ALERT DESIDERABILITÀ SOCIALE ==========
+SCALA_DESIDERABILITA = "Desiderabilità sociale"
+SOGLIA_PERCENTILE_ALERT = 85
+SOGLIA_STANINA_ALERT = 8
+
+
+def alert_desiderabilita(report):
+    """True se la desiderabilità sociale del report supera le soglie di alert."""
+    ds = (report or {}).get(SCALA_DESIDERABILITA, {})
+    return bool(ds) and (
+        ds.get("percentile", 0) >= SOGLIA_PERCENTILE_ALERT
+        or ds.get("stanina", 0) >= SOGLIA_STANINA_ALERT
+    )
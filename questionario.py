@@ -0,0 +1,147 @@
+"""Catalogo degli item compilato una sola volta dalla struttura del test.
+
+Il catalogo è immutabile e indicizzato per posizione dell'item; la sessione
+del candidato porta solo la versione del catalogo e le risposte, non più
+l'intera lista degli item.
+"""
+import hashlib
+import json
+import os
+import pickle
+from types import MappingProxyType
+
+import numpy as np
+
+
+class Questionario:
+    """Item, scale e array di scoring di una versione della struttura."""
+
+    def __init__(self, struttura, versione):
+        self.struttura = struttura
+        self.versione = versione
+        items = []
+        scale = []
+        for area in struttura['areas']:
+            for scala in area['scales']:
+                scale.append(scala['name'])
+                for item in scala['items']:
+                    items.append(MappingProxyType({
+                        "scala": scala['name'],
+                        "text": item['text'],
+                        "reverse": item['reverse']
+                    }))
+        self.items = tuple(items)
+        self.scale = tuple(scale)
+        posizione = {nome: i for i, nome in enumerate(self.scale)}
+        self.indice_scala = np.array([posizione[it["scala"]] for it in items], dtype=np.intp)
+        self.inverso = np.array([it["reverse"] for it in items], dtype=bool)
+        self.indice_scala.flags.writeable = False
+        self.inverso.flags.writeable = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def punteggi_item(self, risposte):
+        """Punteggio di ciascun item (inversione applicata) per 1 o più candidati."""
+        risposte = np.asarray(risposte, dtype=np.int64)
+        inverso = self.inverso[:risposte.shape[-1]]
+        return np.where(inverso, RISPOSTA_MIN + RISPOSTA_MAX - risposte, risposte)
+
+    def punteggi_scale(self, risposte):
+        """Somme per scala con un solo bincount.
+
+        `risposte` è un vettore (un candidato) o una matrice candidati x item;
+        il risultato ha forma (n_scale,) o (n_candidati, n_scale). Se le
+        risposte sono meno degli item vengono considerati i primi item.
+        """
+        risposte = np.asarray(risposte, dtype=np.int64)
+        matrice = np.atleast_2d(risposte)
+        n_candidati, n_item = matrice.shape
+        n_scale = len(self.scale)
+        chiavi = np.arange(n_candidati)[:, None] * n_scale + self.indice_scala[:n_item]
+        somme = np.bincount(
+            chiavi.ravel(),
+            weights=self.punteggi_item(matrice).ravel(),
+            minlength=n_candidati * n_scale
+        ).astype(np.int64).reshape(n_candidati, n_scale)
+        return somme[0] if risposte.ndim == 1 else somme
+
+    def scale_presenti(self, n_risposte):
+        """Maschera delle scale con almeno un item fra i primi `n_risposte`."""
+        return np.bincount(self.indice_scala[:n_risposte], minlength=len(self.scale)) > 0
+
+    def __getstate__(self):
+        stato = dict(self.__dict__)
+        stato["items"] = tuple(dict(it) for it in self.items)
+        return stato
+
+    def __setstate__(self, stato):
+        stato["items"] = tuple(MappingProxyType(it) for it in stato["items"])
+        self.__dict__.update(stato)
+        self.indice_scala.flags.writeable = False
+        self.inverso.flags.writeable = False
+
+    @classmethod
+    def da_file(cls, percorso, cache=True):
+        """Compila la struttura in `percorso`, usando la cache `<percorso>.pickle`.
+
+        La cache è valida solo se è stata prodotta dallo stesso contenuto
+        (hash del file); altrimenti viene ricompilata e riscritta.
+        """
+        with open(percorso, "rb") as f:
+            contenuto = f.read()
+        versione = hashlib.sha1(contenuto).hexdigest()[:12]
+        percorso_cache = percorso + ".pickle"
+        if cache:
+            try:
+                with open(percorso_cache, "rb") as f:
+                    compilato = pickle.load(f)
+                if isinstance(compilato, cls) and compilato.versione == versione:
+                    return compilato
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                pass
+        compilato = cls(json.loads(contenuto.decode("utf-8")), versione)
+        if cache:
+            temporaneo = f"{percorso_cache}.{os.getpid()}.tmp"
+            try:
+                with open(temporaneo, "wb") as f:
+                    pickle.dump(compilato, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temporaneo, percorso_cache)
+            except OSError:
+                pass  # filesystem in sola lettura: si ricompila al prossimo avvio
+        return compilato
+
+
+# ========== RISPOSTE COMPATTE ==========
+# Le risposte Likert (1-6) viaggiano nella sessione come stringa di cifre,
+# un carattere per item: la posizione nella stringa è l'indice dell'item.
+RISPOSTA_MIN = 1
+RISPOSTA_MAX = 6
+
+
+def risposta_valida(valore):
+    return isinstance(valore, int) and RISPOSTA_MIN <= valore <= RISPOSTA_MAX
+
+
+def codifica_risposte(risposte):
+    return "".join(str(r) for r in risposte)
+
+
+def decodifica_risposte(codificate):
+    if isinstance(codificate, list):  # sessioni avviate prima della codifica compatta
+        return [int(r) for r in codificate]
+    return [int(c) for c in codificate or ""]
+
+
+def imposta_risposte(codificate, inizio, nuove):
+    """Scrive `nuove` a partire dalla posizione `inizio`.
+
+    Restituisce None se `inizio` lascerebbe un buco dopo l'ultima risposta data.
+    """
+    if isinstance(codificate, list):
+        codificate = codifica_risposte(codificate)
+    codificate = codificate or ""
+    if inizio < 0 or inizio > len(codificate):
+        return None
+    blocco = codifica_risposte(nuove)
+    return codificate[:inizio] + blocco + codificate[inizio + len(blocco):]
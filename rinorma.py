@@ -0,0 +1,138 @@
+"""Ricalcolo di percentili e stanine di tutti i report sulle norme attuali.
+
+I report salvati sono normati sullo storico disponibile al momento del test:
+questo job li riallinea al gruppo normativo corrente. Lavora a blocchi
+ordinati per seriale, con una transazione per blocco, e registra l'ultimo
+seriale elaborato in un file di checkpoint, così un'esecuzione interrotta
+riprende da dove si era fermata. Un report salvato di nuovo fra la lettura e
+la scrittura del suo blocco non viene sovrascritto: è stato appena normato
+sullo storico corrente.
+
+Un solo ricalcolo alla volta, anche fra processi: il job tiene un lock su
+rinorma.lock e pubblica l'avanzamento in rinorma_stato.json, leggibile da
+qualunque worker.
+
+Uso: python rinorma.py
+"""
+import json
+import os
+
+import numpy as np
+
+import archivio
+import strumenti
+from blocchi import blocco_file, Occupato
+
+CHECKPOINT_FILE = "rinorma.checkpoint"
+LOCK_FILE = "rinorma.lock"
+STATO_FILE = "rinorma_stato.json"
+
+
+def _rinorma_blocco(blocco, indice_per):
+    """Aggiorna in place i report del blocco, una scala (di uno strumento) alla volta."""
+    per_scala = {}
+    for posizione, (seriale, report, strumento, _) in enumerate(blocco):
+        for scala, dati in report.items():
+            per_scala.setdefault((strumento, scala), []).append((posizione, dati.get("punteggio_grezzo", 0)))
+    for (strumento, scala), voci in per_scala.items():
+        posizioni, scores = zip(*voci)
+        percentili, stanine = indice_per(strumento).percentili_stanine(scala, np.array(scores))
+        for posizione, percentile, stanina in zip(posizioni, percentili.tolist(), stanine.tolist()):
+            dati = blocco[posizione][1][scala]
+            dati["percentile"] = percentile
+            dati["stanina"] = stanina
+
+
+def rinorma_report(indice_per, checkpoint=CHECKPOINT_FILE, dimensione_blocco=500, progresso=None):
+    """Ricalcola tutti i report completati; restituisce quanti ne ha aggiornati.
+
+    `indice_per(strumento)` restituisce l'IndiceNorme dello strumento del
+    report; `progresso(elaborati, ultimo_seriale)` viene chiamata dopo ogni
+    blocco.
+    """
+    dopo = ""
+    if os.path.exists(checkpoint):
+        with open(checkpoint, "r", encoding="utf-8") as f:
+            dopo = f.read().strip()
+    elaborati = 0
+    for blocco in archivio.itera_report(dopo, dimensione_blocco):
+        _rinorma_blocco(blocco, indice_per)
+        saltati = archivio.aggiorna_report(
+            [(seriale, report, revisione) for seriale, report, _, revisione in blocco]
+        )
+        elaborati += len(blocco) - len(saltati)
+        ultimo = blocco[-1][0]
+        with open(checkpoint, "w", encoding="utf-8") as f:
+            f.write(ultimo)
+        if progresso:
+            progresso(elaborati, ultimo)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return elaborati
+
+
+def _scrivi_stato(**stato):
+    temporaneo = STATO_FILE + ".tmp"
+    with open(temporaneo, "w", encoding="utf-8") as f:
+        json.dump(stato, f)
+    os.replace(temporaneo, STATO_FILE)
+
+
+def leggi_stato():
+    stato = {"in_corso": False, "elaborati": 0, "ultimo": "", "errore": None}
+    if os.path.exists(STATO_FILE):
+        with open(STATO_FILE, "r", encoding="utf-8") as f:
+            stato.update(json.load(f))
+    if stato["in_corso"]:
+        try:
+            with blocco_file(LOCK_FILE, attendi=False):
+                # nessuno tiene il lock: il job è stato interrotto (riprenderà dal checkpoint)
+                stato.update(in_corso=False, errore="interrotto")
+        except Occupato:
+            pass
+    return stato
+
+
+def _indici_aggiornati(storico_per):
+    """indice_per(strumento) che allinea ogni storico una sola volta per esecuzione."""
+    indici = {}
+
+    def indice_per(strumento):
+        if strumento not in indici:
+            storico = storico_per(strumento)
+            storico.aggiorna()
+            indici[strumento] = storico.indice
+        return indici[strumento]
+    return indice_per
+
+
+def esegui_con_stato(storico_per):
+    """Esegue il ricalcolo pubblicando lo stato; False se un altro job è già in corso.
+
+    `storico_per(strumento)` restituisce lo StoricoNorme dello strumento.
+    """
+    try:
+        with blocco_file(LOCK_FILE, attendi=False):
+            _scrivi_stato(in_corso=True, elaborati=0, ultimo="", errore=None)
+            progresso = lambda elaborati, ultimo: _scrivi_stato(
+                in_corso=True, elaborati=elaborati, ultimo=ultimo, errore=None)
+            try:
+                elaborati = rinorma_report(_indici_aggiornati(storico_per), progresso=progresso)
+            except Exception as e:
+                stato = leggi_stato()
+                _scrivi_stato(in_corso=False, elaborati=stato["elaborati"], ultimo=stato["ultimo"],
+                              errore=str(e))
+                raise
+            _scrivi_stato(in_corso=False, elaborati=elaborati, ultimo="", errore=None)
+            return True
+    except Occupato:
+        return False
+
+
+if __name__ == "__main__":
+    with blocco_file(LOCK_FILE, attendi=False):
+        totale = rinorma_report(
+            _indici_aggiornati(strumenti.storico),
+            progresso=lambda n, ultimo: print(f"{n} report ricalcolati (ultimo: {ultimo})")
+        )
+    print(f"Ricalcolo completato: {totale} report aggiornati")
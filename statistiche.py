@@ -0,0 +1,33 @@
+"""Statistiche del dashboard admin.
+
+Contatori, utilizzo per giorno e somme dei punteggi per scala sono tenuti
+da archivio.py in tabelle aggiornate nella stessa transazione di ogni
+riscatto, report e generazione di codici: la lettura non scandisce i
+codici e non dipende dal processo che ha scritto.
+"""
+import archivio
+
+
+class StatisticheAdmin:
+
+    def attuali(self):
+        """Restituisce (versione, stats, usage_trend, scale_averages)."""
+        versione, contatori, per_giorno, scale = archivio.statistiche()
+        totale = contatori.get("totale", 0)
+        usati = contatori.get("usati", 0)
+        completati = contatori.get("completati", 0)
+        usage_rate = round((usati / totale) * 100, 1) if totale > 0 else 0
+        completion_rate = round((completati / usati) * 100, 1) if usati > 0 else 0
+        stats = {
+            "total_codes": totale,
+            "used_codes": usati,
+            "completed_tests": completati,
+            "available_codes": totale - usati,
+            "usage_rate": usage_rate,
+            "completion_rate": completion_rate
+        }
+        medie = {
+            scala: round(somma / conteggio, 1)
+            for scala, (somma, conteggio) in scale.items()
+        }
+        return versione, stats, per_giorno, medie
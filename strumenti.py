@@ -0,0 +1,105 @@
+"""Strumenti (questionari) serviti dall'applicazione.
+
+Ogni strumento ha la propria struttura (stesso formato di data.json), il
+proprio questionario compilato e il proprio storico normativo. Lo
+strumento predefinito è quello di sempre: data.json con le norme in
+database.json/database.jsonl. Gli altri stanno in strumenti/<id>.json con
+le norme in norme_strumenti/<id>.json(l).
+
+Il codice seriale porta l'id del suo strumento (assegnato alla generazione
+del lotto). Ogni strumento viene compilato e caricato solo la prima volta
+che serve in un processo: aggiungerne non allunga l'avvio.
+"""
+import os
+import re
+import threading
+
+import norme
+from questionario import Questionario
+
+PREDEFINITO = "bip"
+CARTELLA = "strumenti"
+CARTELLA_NORME = "norme_strumenti"
+
+_ID_VALIDO = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_lock = threading.Lock()
+_questionari = {}
+_storici = {}
+
+
+def _valida(strumento):
+    strumento = strumento or PREDEFINITO
+    if not _ID_VALIDO.match(strumento):
+        raise ValueError(f"Id di strumento non valido: {strumento}")
+    return strumento
+
+
+def percorso(strumento=None):
+    """File della struttura dello strumento."""
+    strumento = _valida(strumento)
+    if strumento == PREDEFINITO:
+        return "data.json"
+    return os.path.join(CARTELLA, f"{strumento}.json")
+
+
+def esiste(strumento):
+    try:
+        return os.path.exists(percorso(strumento))
+    except ValueError:
+        return False
+
+
+def da_salvare(strumento):
+    """Id dello strumento da registrare sui codici: None per il predefinito.
+
+    ValueError se lo strumento non esiste.
+    """
+    if not strumento or strumento == PREDEFINITO:
+        return None
+    if not esiste(strumento):
+        raise ValueError(f"Strumento sconosciuto: {strumento}")
+    return strumento
+
+
+def elenco():
+    """Id degli strumenti disponibili, il predefinito per primo."""
+    ids = [PREDEFINITO]
+    if os.path.isdir(CARTELLA):
+        ids.extend(sorted(
+            nome[:-len(".json")] for nome in os.listdir(CARTELLA)
+            if nome.endswith(".json") and _ID_VALIDO.match(nome[:-len(".json")])
+            and nome[:-len(".json")] != PREDEFINITO
+        ))
+    return ids
+
+
+def questionario(strumento=None):
+    """Questionario compilato dello strumento (compilato alla prima richiesta)."""
+    strumento = _valida(strumento)
+    compilato = _questionari.get(strumento)
+    if compilato is None:
+        with _lock:
+            compilato = _questionari.get(strumento)
+            if compilato is None:
+                if not esiste(strumento):
+                    raise ValueError(f"Strumento sconosciuto: {strumento}")
+                compilato = _questionari[strumento] = Questionario.da_file(percorso(strumento))
+    return compilato
+
+
+def storico(strumento=None):
+    """Storico normativo dello strumento (caricato in modo lazy, vedi norme.StoricoNorme)."""
+    strumento = _valida(strumento)
+    storico_norme = _storici.get(strumento)
+    if storico_norme is None:
+        with _lock:
+            storico_norme = _storici.get(strumento)
+            if storico_norme is None:
+                if strumento == PREDEFINITO:
+                    storico_norme = norme.StoricoNorme()
+                else:
+                    os.makedirs(CARTELLA_NORME, exist_ok=True)
+                    base = os.path.join(CARTELLA_NORME, strumento)
+                    storico_norme = norme.StoricoNorme(f"{base}.json", f"{base}.jsonl")
+                _storici[strumento] = storico_norme
+    return storico_norme
@@ -0,0 +1,77 @@
+import string
+from collections import Counter
+
+import pytest
+
+import archivio
+
+
+def test_genera_codici_distribuzione_caratteri(cartella):
+    seriali = []
+    for _ in range(400):
+        _, nuovi = archivio.genera_codici(50, prefix="T")
+        assert len(nuovi) == 50
+        seriali.extend(nuovi)
+    assert len(set(seriali)) == len(seriali)
+
+    alfabeto = string.ascii_uppercase + string.digits
+    atteso = len(seriali) / len(alfabeto)
+    for posizione in range(2, 8):
+        conteggi = Counter(s[posizione] for s in seriali)
+        for carattere in alfabeto:
+            assert 0.75 * atteso < conteggi[carattere] < 1.25 * atteso, (posizione, carattere)
+
+
+def test_genera_codici_tiene_i_primi_estratti(cartella, monkeypatch):
+    estratti = [f"T-{c}{c}{c}{c}{c}{c}" for c in "ZYXWVUTSRQPONMLKJIHGFEDCBA"]
+    monkeypatch.setattr(archivio, "_estrai_seriali", lambda n, *a: estratti[:n])
+    _, nuovi = archivio.genera_codici(5, prefix="T")
+    assert nuovi == sorted(estratti[:5])
+
+
+def test_genera_codici_prefisso_non_valido(cartella):
+    with pytest.raises(ValueError, match="Prefisso non valido"):
+        archivio.genera_codici(5, prefix="CAFÉ")
+
+
+def _report(punteggio):
+    return {"A": {"punteggio_grezzo": punteggio, "percentile": 50, "stanina": 5}}
+
+
+def test_statistiche_incrementali_uguali_alla_ricostruzione(cartella):
+    _, codici = archivio.genera_codici(6, prefix="T")
+    archivio.riscatta_codice(codici[0], "N", "a@x.it", "01/02/2024 10:00")
+    archivio.riscatta_codice(codici[1], "N", "b@x.it", "01/02/2024 11:00")
+    archivio.riscatta_codice(codici[2], "N", "c@x.it", "02/02/2024 09:00")
+    archivio.salva_report(codici[0], _report(10), [])
+    archivio.salva_report(codici[1], _report(20), [])
+    archivio.salva_report(codici[1], _report(30), [])  # riscritto
+    archivio.salva_report(codici[3], _report(5), [])  # codice non riscattato
+    archivio.riscatta_codice(codici[3], "N", "d@x.it", "02/02/2024 12:00")
+
+    _, contatori, per_giorno, scale = archivio.statistiche()
+    assert contatori == {"totale": 7, "usati": 4, "completati": 3}
+    assert per_giorno == {"01/02/2024": 2, "02/02/2024": 2}
+    assert scale == {"A": (45, 3)}
+
+    transazione = archivio._transazione()
+    with transazione as conn:
+        archivio._ricostruisci_statistiche(conn)
+    assert archivio.statistiche()[1:] == (contatori, per_giorno, scale)
+
+
+def test_aggiorna_report_non_sovrascrive_un_report_piu_recente(cartella):
+    _, (primo, secondo) = archivio.genera_codici(2, prefix="T")
+    archivio.salva_report(primo, _report(10), [])
+    archivio.salva_report(secondo, _report(20), [])
+    blocco = next(archivio.itera_report())
+
+    archivio.salva_report(primo, _report(15), [{"idx": 1}])
+    saltati = archivio.aggiorna_report([
+        (seriale, dict(report, A=dict(report["A"], percentile=99)), revisione)
+        for seriale, report, _, revisione in blocco
+    ])
+
+    assert saltati == [primo]
+    assert archivio.leggi_codice(primo)["report"] == _report(15)
+    assert archivio.leggi_codice(secondo)["report"]["A"]["percentile"] == 99
@@ -0,0 +1,49 @@
+import json
+
+import archivio
+from completamenti import Completamenti
+from norme import StoricoNorme
+
+
+def _report(punteggio):
+    return {"A": {"punteggio_grezzo": punteggio, "percentile": 50, "stanina": 5}}
+
+
+def test_compatta_riapplica_il_journal_senza_duplicati(cartella):
+    storico = StoricoNorme()
+    coda = Completamenti(lambda strumento: storico)
+    _, codici = archivio.genera_codici(3, prefix="T")
+    for i, seriale in enumerate(codici[:2]):
+        coda.accoda(seriale, _report(10 + i), [{"idx": 1}], [{"scala": "A", "score": 10 + i}])
+    assert coda.attendi(10)
+    with open("completamenti.jsonl", "rb") as f:
+        journal = f.read()
+    versione = archivio.versione_dati()
+
+    # journal non svuotato (crash) e coda incompleta di una terza scrittura
+    with open("completamenti.jsonl", "ab") as f:
+        f.write(b'\n{"id": "x", "seriale": "' + codici[2].encode() + b'", "rep')
+    assert coda.compatta() == 2
+    with open("completamenti.jsonl", "wb") as f:
+        f.write(journal)
+    assert coda.compatta() == 2
+
+    assert archivio.versione_dati() == versione
+    assert StoricoNorme().carica().indice.totale("A") == 2
+    assert archivio.leggi_codice(codici[1])["report"] == _report(11)
+    assert "report" not in archivio.leggi_codice(codici[2])
+    assert archivio.statistiche()[3] == {"A": (21, 2)}
+
+
+def test_compatta_applica_i_completamenti_non_ancora_scritti(cartella):
+    _, (seriale,) = archivio.genera_codici(1, prefix="T")
+    voce = {"id": "c1", "strumento": None, "seriale": seriale, "report": _report(7),
+            "risposte_dettaglio": [], "norme": [{"scala": "A", "score": 7}]}
+    with open("completamenti.jsonl", "w", encoding="utf-8") as f:
+        f.write("\n" + json.dumps(voce) + "\n")
+
+    coda = Completamenti(lambda strumento: StoricoNorme())
+    assert coda.compatta() == 1
+    assert archivio.leggi_codice(seriale)["report"] == _report(7)
+    assert StoricoNorme().carica().completamenti == {"c1"}
+    assert coda.compatta() == 0
@@ -0,0 +1,37 @@
+import archivio
+import coorti
+
+
+def _report(punteggio):
+    return {"A": {"punteggio_grezzo": punteggio, "percentile": 50, "stanina": 5}}
+
+
+def test_coorte_si_riallinea_alle_scritture_di_altri_processi(cartella, monkeypatch):
+    _, codici = archivio.genera_codici(4, prefix="T")
+    _, altri = archivio.genera_codici(2, prefix="T")
+    for seriale, punteggio in zip(codici + altri, (10, 20, 30, 40, 50, 60)):
+        archivio.salva_report(seriale, _report(punteggio), [])
+    norme = coorti.NormeCoorti()  # non in ascolto: le scritture seguenti sono "di un altro processo"
+    info = archivio.leggi_codice(codici[0])
+    assert norme.report_relativo(codici[0], info)[1] == 4
+    assert norme.report_relativo(altri[0], archivio.leggi_codice(altri[0]))[1] == 2
+
+    archivio.salva_report(codici[1], _report(5), [])
+    archivio.salva_report(codici[2], _report(35), [])
+    letti = []
+    report_coorte = archivio.report_coorte
+    monkeypatch.setattr(archivio, "report_coorte", lambda **k: letti.append(k) or report_coorte(**k))
+
+    chiave, numerosita, report = norme.report_relativo(codici[0], info)
+    assert norme.report_relativo(altri[0], archivio.leggi_codice(altri[0]))[1] == 2
+    # nessuna ricostruzione completa: solo le righe modificate nel frattempo
+    assert [k["dopo_revisione"] is not None for k in letti] == [True, True]
+    ricostruita = coorti._Coorte(*coorti._report_coorte(chiave)).indice
+    assert numerosita == 4
+    assert report["A"]["percentile"] == ricostruita.percentile_stanina("A", 10)[0] == 25
+
+
+def test_seriale_senza_prefisso_non_ha_coorte():
+    assert coorti.prefisso("GO2B-AB12CD") == "GO2B"
+    assert coorti.prefisso("AB12CD") is None
+    assert coorti.chiave_coorte("prefisso", "AB12CD", None, None) is None
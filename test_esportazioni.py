@@ -0,0 +1,53 @@
+import json
+import subprocess
+import sys
+import time
+
+import esportazioni
+
+
+def _scrivi(percorso):
+    with open(percorso, "w") as f:
+        f.write("ok")
+
+
+def _attendi_pronto(coda, job_id):
+    for _ in range(200):
+        if coda.file_pronto(job_id):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_avvia_riavvia_job_di_un_worker_terminato(cartella):
+    coda = esportazioni.CodaEsportazioni(cartella=str(cartella / "cache"))
+    (cartella / "cache").mkdir()
+    morto = subprocess.Popen([sys.executable, "-c", "pass"])
+    morto.wait()
+    with open(cartella / "cache" / "users-3.json", "w") as f:
+        json.dump({"id": "users-3", "tipo": "users", "stato": "in_corso", "creato": time.time(), "pid": morto.pid}, f)
+
+    assert coda.stato("users-3")["stato"] == "errore"
+    assert coda.stato("users-3")["errore"] == "abbandonato"
+    assert coda.avvia("users", 3, _scrivi) == "users-3"
+    assert _attendi_pronto(coda, "users-3")
+
+
+def test_avvia_non_duplica_job_in_corso(cartella):
+    coda = esportazioni.CodaEsportazioni(cartella=str(cartella / "cache"))
+    (cartella / "cache").mkdir()
+    coda._scrivi_stato("users-3", tipo="users", stato="in_corso", creato=time.time())
+    eseguiti = []
+
+    assert coda.avvia("users", 3, eseguiti.append) == "users-3"
+    time.sleep(0.05)
+    assert not eseguiti
+
+
+def test_stato_job_scaduto_risulta_in_errore(cartella):
+    coda = esportazioni.CodaEsportazioni(cartella=str(cartella / "cache"))
+    (cartella / "cache").mkdir()
+    creato = time.time() - esportazioni.DURATA_MASSIMA_JOB - 1
+    coda._scrivi_stato("users-3", tipo="users", stato="in_corso", creato=creato)
+
+    assert coda.stato("users-3")["stato"] == "errore"
@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+
+from norme import IndiceNorme, StoricoNorme
+
+
+def _percentile_stanina_originale(scores, score):
+    """Calcolo di result() prima dell'indice: lista completa, punteggio già registrato."""
+    percentile = int(round((np.sum(np.array(scores) < score) / len(scores)) * 100))
+    position = sorted(scores).index(score)
+    stanina = int(np.ceil(((position + 1) / len(scores)) * 9))
+    return percentile, min(max(stanina, 1), 9)
+
+
+def test_indice_uguale_all_algoritmo_originale():
+    rng = np.random.default_rng(7)
+    indice = IndiceNorme()
+    storico = []
+    for score in rng.integers(4, 40, size=600).tolist():
+        atteso_nuovo = indice.percentile_stanina("A", score, nuovo=True)
+        storico.append(score)
+        indice.aggiungi("A", score)
+        atteso = _percentile_stanina_originale(storico, score)
+        assert atteso_nuovo == atteso
+        assert indice.percentile_stanina("A", score) == atteso
+
+    percentili, stanine = indice.percentili_stanine("A", np.array(storico))
+    assert list(zip(percentili.tolist(), stanine.tolist())) == [
+        _percentile_stanina_originale(storico, s) for s in storico
+    ]
+
+
+def _record(*scores):
+    return [{"scala": "A", "score": s} for s in scores]
+
+
+def test_storico_scarta_la_riga_interrotta(cartella):
+    storico = StoricoNorme().carica()
+    storico.registra_completamenti([("c1", _record(10, 11)), ("c2", _record(12))])
+    with open("database.jsonl", "ab") as f:
+        f.write(b'{"scala": "A", "sco')  # crash a metà scrittura
+
+    riaperto = StoricoNorme().carica()
+    assert [r["score"] for r in riaperto.record] == [10, 11, 12]
+    assert riaperto.completamenti == {"c1", "c2"}
+
+    riaperto.registra_completamenti([("c3", _record(13))])
+    assert [r["score"] for r in StoricoNorme().carica().record] == [10, 11, 12, 13]
+
+
+def test_storico_salta_il_journal_gia_nello_snapshot(cartella):
+    storico = StoricoNorme().carica()
+    storico.registra_completamenti([("c1", _record(10)), ("c2", _record(11, 12))])
+    with open("database.jsonl", "rb") as f:
+        journal = f.read()
+    storico.compatta()
+    with open("database.jsonl", "wb") as f:
+        f.write(journal)  # crash dopo lo snapshot, prima di svuotare il journal
+
+    riaperto = StoricoNorme().carica()
+    assert [r["score"] for r in riaperto.record] == [10, 11, 12]
+    assert riaperto.indice.totale("A") == 3
+    with open("database.json", "r", encoding="utf-8") as f:
+        assert len(json.load(f)) == 3
+
+
+def test_storico_non_registra_due_volte_lo_stesso_completamento(cartella):
+    storico = StoricoNorme().carica()
+    assert storico.registra_completamenti([("c1", _record(10)), ("c1", _record(10))]) == ["c1"]
+    assert StoricoNorme().carica().registra_completamenti([("c1", _record(10))]) == []
+    assert StoricoNorme().carica().indice.totale("A") == 1